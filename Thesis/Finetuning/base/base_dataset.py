@@ -1,7 +1,6 @@
 import pandas as pd
 import sys
 import re
-import librosa
 import numpy as np
 from pandarallel import pandarallel
 from typing import Dict, List
@@ -11,13 +10,15 @@ sys.path.append('..')
 
 from sklearn.model_selection import train_test_split
 from utils.feature import load_wav
+from utils.audio_metadata import load_metadata, metadata_path, update_metadata
+from utils.arena import WaveformArena, arena_exists, arena_path, build_arena
 from tqdm import tqdm
 from torch.utils.data import Dataset
 from dataloader.dataset import Dataset as InstanceDataset
 
 
 class BaseDataset(Dataset):
-    def __init__(self, rank, dist, path, sr, delimiter, special_tokens, min_duration = -np.inf, max_duration = np.inf, preload_data = False, transform = None, nb_workers = 4):
+    def __init__(self, rank, dist, path, sr, delimiter, special_tokens, min_duration = -np.inf, max_duration = np.inf, preload_data = False, transform = None, nb_workers = 4, arena_dir = '/dev/shm', arena_dtype = 'int16'):
         self.rank = rank
         self.dist = dist
         self.sr = sr
@@ -25,6 +26,7 @@ class BaseDataset(Dataset):
         self.chars_to_ignore = r'[,?.!\-;:"“%\'�]'
         self.transform = transform
         self.preload_data = preload_data
+        self.arena = None
         self.min_duration = min_duration
         self.max_duration = max_duration
         self.df = self.load_data(path, delimiter)
@@ -32,12 +34,13 @@ class BaseDataset(Dataset):
         pandarallel.initialize(progress_bar=True, nb_workers = nb_workers)
 
         if min_duration != -np.inf or max_duration != np.inf:
-            if self.rank == 0 and 'duration' not in self.df.columns:
-                print("\n*****Generate duration column*****")
-                self.df['duration'] = self.df['path'].parallel_apply(lambda filename: librosa.get_duration(filename=filename))
-                self.df.to_csv(path, index = False, sep = delimiter)
-            self.dist.barrier()
-            self.df = self.load_data(path, delimiter)
+            if 'duration' not in self.df.columns:
+                # Durations from the header-only metadata cache next to the manifest, only new or changed files are read
+                if self.rank == 0:
+                    print("\n*****Update audio metadata*****")
+                    update_metadata(path, self.df['path'], num_workers = nb_workers)
+                self.dist.barrier()
+                self.df['duration'] = self.df['path'].map(load_metadata(metadata_path(path))['duration'])
             if self.rank == 0:
                 print("\n*****Filter out invalid audio*****")
             mask = (self.df['duration'] <= self.max_duration) & (self.df['duration'] >= self.min_duration)
@@ -45,9 +48,16 @@ class BaseDataset(Dataset):
         self.df['transcript'] = self.df['transcript'].parallel_apply(self.remove_special_characters)
     
         if self.preload_data:
+            # Rank 0 decodes the waveforms once into a memory-mapped arena shared by all ranks, indexed by row
+            self.df = self.df.reset_index(drop = True)
+            path = arena_path(arena_dir, self.df['path'], self.sr, arena_dtype)
+            if self.rank == 0 and not arena_exists(path):
+                print(f"\n*****Preloading {len(self.df)} data into {path}*****")
+                build_arena(list(self.df['path']), self.sr, path, arena_dtype, num_workers = nb_workers)
+            self.dist.barrier()
+            self.arena = WaveformArena(path)
             if self.rank == 0:
-                print(f"\n*****Preloading {len(self.df)} data*****")
-            self.df['wav'] = self.df['path'].parallel_apply(lambda filepath: load_wav(filepath, sr = self.sr))
+                print(f"\n*****Preloaded {len(self.arena)} data, {self.arena.size_mb():.0f} MB shared by all ranks*****")
         
     def remove_special_characters(self, transcript) -> str:
         transcript = re.sub(self.chars_to_ignore, '', transcript).lower()
@@ -83,7 +93,7 @@ class BaseDataset(Dataset):
         return df
 
     def get_data(self) -> Dataset:
-        ds = InstanceDataset(self.df, self.sr, self.preload_data, self.transform)
+        ds = InstanceDataset(self.df, self.sr, self.preload_data, self.transform, arena = self.arena)
         return ds
 
 
@@ -3,8 +3,15 @@ sys.path.append("../")
 import torch
 
 from utils.feature import load_wav
+from pathlib import Path
+from utils.utils import import_from_path
 from typing import Dict
 
+# The array-backed manifest is shared with the pretraining pipeline
+CompactManifest = import_from_path(
+    "pretraining_manifest", Path(__file__).resolve().parents[2] / "Pretraining" / "manifest.py"
+).CompactManifest
+
 class DefaultCollate:
     def __init__(self, processor, sr) -> None:
         self.processor = processor
@@ -33,20 +40,23 @@ class DefaultCollate:
         return batch
 
 class Dataset:
-    def __init__(self, data, sr, preload_data, transform = None):
-        self.data = data
+    def __init__(self, data, sr, preload_data, transform = None, arena = None):
+        # Array-backed manifest, so forked DataLoader workers do not copy the DataFrame on read
+        columns = [c for c in ['path', 'transcript', 'duration'] if c in data.columns]
+        self.data = CompactManifest(data, columns = columns)
         self.sr = sr
         self.transform = transform
         self.preload_data = preload_data
+        # WaveformArena of the preloaded waveforms, in the order of the rows of data
+        self.wavs = arena if preload_data else None
         
     def __len__(self) -> int:
         return len(self.data)
         
     def __getitem__(self, idx) -> tuple:
-        item = self.data.iloc[idx]
         if not self.preload_data:
-            feature = load_wav(item['path'], sr = self.sr)
+            feature = load_wav(self.data.get('path', idx), sr = self.sr)
         else:
-            feature = item['wav']
+            feature = self.wavs[idx]
         
-        return feature, item['transcript']
+        return feature, self.data.get('transcript', idx)
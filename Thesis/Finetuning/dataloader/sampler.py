@@ -0,0 +1,30 @@
+from pathlib import Path
+from torch.utils.data.distributed import DistributedSampler
+from typing import Iterator
+from utils.utils import import_from_path
+
+# The length-grouped batch samplers are shared with pretraining: BucketBatchSampler groups clips of similar duration
+# into batches, hands out batches of similar duration to every rank and reports its padding with `padding_stats`
+samplers = import_from_path("pretraining_samplers", Path(__file__).resolve().parents[2] / "Pretraining" / "samplers.py")
+BucketBatchSampler = samplers.BucketBatchSampler
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    """
+    DistributedSampler that can start an epoch at a given position, so resuming training skips the examples seen
+    before the checkpoint without loading them. The order of the epoch is unchanged, it still only depends on the
+    seed and the epoch set by `set_epoch`, and `__len__` stays the length of the full epoch.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.start_index = 0
+
+    def set_start_index(self, start_index: int) -> None:
+        # Only applies to the next iteration, e.g. (resumed batches * batch size)
+        self.start_index = start_index
+
+    def __iter__(self) -> Iterator[int]:
+        start_index, self.start_index = self.start_index, 0
+        indices = list(super().__iter__())
+        return iter(indices[start_index:])
+
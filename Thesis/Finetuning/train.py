@@ -15,6 +15,7 @@ from time import gmtime, strftime
 from utils.utils import *
 from utils.metric import Metric
 from dataloader.dataset import DefaultCollate
+from dataloader.sampler import BucketBatchSampler, ResumableDistributedSampler
 from transformers import Wav2Vec2ForCTC, Wav2Vec2FeatureExtractor, Wav2Vec2CTCTokenizer, Wav2Vec2Processor
 
 def setup(rank, world_size):
@@ -85,18 +86,40 @@ def main(rank, world_size, config, resume, preload, pretrained_path):
 
     # Create train dataloader
     train_ds = train_base_ds.get_data()
-    train_sampler = torch.utils.data.distributed.DistributedSampler(
-        train_ds,
-        num_replicas=world_size,
-        rank=rank,
-        **config["train_dataset"]["sampler"]
-    )
-    train_dl = DataLoader(
-        dataset=train_ds,
-        **config["train_dataset"]["dataloader"],
-        sampler = train_sampler,
-        collate_fn=default_collate
-    )
+    sampler_args = dict(config["train_dataset"]["sampler"])
+    if sampler_args.pop("group_by_duration", False):
+        # Batches of clips with similar duration, the batch sampler takes over batch_size, shuffle and drop_last
+        assert 'duration' in train_ds.data, "group_by_duration needs a duration column, set min_duration or max_duration of the train dataset"
+        dataloader_args = dict(config["train_dataset"]["dataloader"])
+        dataloader_args.pop("shuffle", None)
+        sampler_args.pop("shuffle", None)
+        train_sampler = BucketBatchSampler(
+            train_ds.data.column('duration'),
+            batch_size = dataloader_args.pop("batch_size"),
+            drop_last = dataloader_args.pop("drop_last", sampler_args.pop("drop_last", False)),
+            num_replicas = world_size,
+            rank = rank,
+            **sampler_args
+        )
+        train_dl = DataLoader(
+            dataset=train_ds,
+            **dataloader_args,
+            batch_sampler = train_sampler,
+            collate_fn=default_collate
+        )
+    else:
+        train_sampler = ResumableDistributedSampler(
+            train_ds,
+            num_replicas=world_size,
+            rank=rank,
+            **sampler_args
+        )
+        train_dl = DataLoader(
+            dataset=train_ds,
+            **config["train_dataset"]["dataloader"],
+            sampler = train_sampler,
+            collate_fn=default_collate
+        )
 
     # Create val dataloader
     val_base_ds = initialize_module(config["val_dataset"]["path"], args=config["val_dataset"]["args"])
@@ -1,5 +1,7 @@
 from ctypes import Union
 from typing import Any
+import contextlib
+import time
 import torch
 
 from base.base_trainer import BaseTrainer
@@ -59,7 +61,13 @@ class Trainer(BaseTrainer):
         self.sr = config["meta"]["sr"]
         self.n_gpus = n_gpus
         self.max_clip_grad_norm = max_clip_grad_norm
-        self.stateful_metrics = ["train_loss", "train_lr", "train_grad_norm", "train_wer", "val_loss", "val_wer"]
+        self.stateful_metrics = ["train_loss", "train_lr", "train_grad_norm", "train_wer", "train_comm_saved_ms", "val_loss", "val_wer", "val_cer"]
+        # Corpus-level train WER of every `train_wer_interval`-th optimizer step
+        self.train_wer_interval = config["trainer"]["args"].get("train_wer_interval", 1)
+        self.train_wer_counts = torch.zeros(4, dtype=torch.long)
+        # Time the backward passes with and without gradient all-reduce to estimate the communication saved by no_sync
+        self.measure_comm_time = config["trainer"]["args"].get("measure_comm_time", False)
+        self.backward_times = {"sync": [], "no_sync": []}
 
     def get_grad_norm(self, params, scale=1) -> torch.tensor:
         """Compute grad norm given a gradient scale."""
@@ -72,47 +80,85 @@ class Trainer(BaseTrainer):
         return total_norm
 
 
-    def gather(self, value: torch.tensor) -> Any:
-        # gather value across devices - https://pytorch.org/docs/stable/distributed.html#torch.distributed.all_gather
-        if value.ndim == 0:
-            value = value.clone()[None]
-        output_tensors = [value.clone() for _ in range(self.dist.get_world_size())]
-        self.dist.all_gather(output_tensors, value)
-        return torch.cat(output_tensors, dim=0)
-    
+    def synchronized_time(self, device: torch.device) -> float:
+        """Host clock once the queued kernels of `device` have finished, CPU runs (e.g. gloo without GPUs) need no wait."""
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        return time.perf_counter()
+
+    def comm_time_saved(self) -> float:
+        """
+        Communication time saved per optimizer step by skipping the all-reduce of the accumulation micro-steps: the
+        extra time of a synchronized backward pass over an unsynchronized one, times the number of skipped all-reduces.
+        """
+        sync = sum(self.backward_times["sync"]) / len(self.backward_times["sync"])
+        no_sync = sum(self.backward_times["no_sync"]) / len(self.backward_times["no_sync"])
+        self.backward_times = {"sync": [], "no_sync": []}
+        return max(sync - no_sync, 0.0) * (self.gradient_accumulation_steps - 1)
+
+    def reduce(self, values: Dict[str, Any], sum_keys = ()) -> Dict[str, torch.Tensor]:
+        """
+        Reduce scalars and small tensors across devices with a single all_reduce: the values are packed into one
+        float64 tensor on the CPU (exact for counts), summed, and averaged over devices except for `sum_keys`.
+        """
+        values = {k: torch.as_tensor(v).detach().cpu().to(torch.float64) for k, v in values.items()}
+        if self.n_gpus > 1:
+            packed = torch.cat([v.reshape(-1) for v in values.values()])
+            self.dist.all_reduce(packed, op = self.dist.ReduceOp.SUM)
+            offset = 0
+            for k, v in values.items():
+                values[k] = packed[offset:offset + v.numel()].view(v.shape)
+                offset += v.numel()
+        return {k: v if k in sum_keys else v / self.n_gpus for k, v in values.items()}
+
     def _train_epoch(self, epoch) -> None:
         self.train_sampler.set_epoch(epoch)
 
         if self.rank == 0:
             print("\nEpoch {}: ".format(epoch+1))
+            if hasattr(self.train_sampler, "padding_stats"):
+                padding = self.train_sampler.padding_stats()
+                print("Padding ratio: {:.3f} (random batches: {:.3f})".format(padding["padding_ratio"], padding["padding_ratio_random"]))
+                self.writer.update(self.completed_steps, 'Train', padding)
             pbar = PBar(self.steps_per_epoch, 10, stateful_metrics = self.stateful_metrics)
         
-        if self.resume_step >= 0 and self.rank == 0:
-            print("*****Load previous time steps******")
-            resume_pbar = tqdm(total=self.resume_step+1)
+        # Continue after the last batch of the checkpoint, the sampler skips the previous batches without loading them
+        start_step = 0
+        if self.resume_step >= 0:
+            start_step = self.resume_step + 1
+            if hasattr(self.train_sampler, "set_start_batch"):
+                self.train_sampler.set_start_batch(start_step)
+            else:
+                self.train_sampler.set_start_index(start_step * self.train_dl.batch_size)
+            self.resume_step = -1
+            if self.rank == 0:
+                print(f"*****Skip the first {start_step} batches of the epoch******")
+
+        for dl_step, batch in enumerate(self.train_dl, start = start_step):
+            is_update_step = (dl_step + 1) % self.gradient_accumulation_steps == 0 or dl_step == len(self.train_dl) - 1
+            # DDP only needs to all-reduce the gradients in the backward pass of the update step
+            sync_context = self.model.no_sync() if self.n_gpus > 1 and not is_update_step else contextlib.nullcontext()
+            with sync_context:
+                with autocast(enabled=self.use_amp):
+                    # forward
+                    self.model.train()
+                    outputs = self.model(**batch)
 
-        for dl_step, batch in enumerate(self.train_dl):
-            if self.resume_step >= 0:
-                self.resume_step -= 1
-                if self.rank == 0:
-                    resume_pbar.update()
-                    if self.resume_step < 0:
-                        resume_pbar.close()
-                continue
-            with autocast(enabled=self.use_amp):
-                # forward
-                self.model.train()
-                outputs = self.model(**batch)
-
-                # divide loss by gradient accumulation steps since gradients
-                # are accumulated for multiple backward passes in PyTorch
-                loss = outputs.loss / self.gradient_accumulation_steps
-            self.scaler.scale(loss).backward()
-
-            wer = torch.tensor(self.compute_metric(outputs.logits.detach(), batch['labels']))
+                    # divide loss by gradient accumulation steps since gradients
+                    # are accumulated for multiple backward passes in PyTorch
+                    loss = outputs.loss / self.gradient_accumulation_steps
+                if self.measure_comm_time:
+                    start_time = self.synchronized_time(loss.device)
+                self.scaler.scale(loss).backward()
+                if self.measure_comm_time:
+                    self.backward_times["sync" if is_update_step else "no_sync"].append(self.synchronized_time(loss.device) - start_time)
+
+            compute_wer = self.completed_steps % self.train_wer_interval == 0
+            if compute_wer:
+                self.train_wer_counts += self.compute_metric.update(outputs.logits.detach(), batch['labels'])
 
             # Optimize step
-            if (dl_step + 1) % self.gradient_accumulation_steps == 0 or dl_step == len(self.train_dl) - 1:
+            if is_update_step:
                 # compute grad norm for monitoring
                 grad_norm = self.get_grad_norm(self.model.parameters(), scale = self.scaler.get_scale())
 
@@ -134,17 +180,22 @@ class Trainer(BaseTrainer):
                     self.scheduler.step()
                 
                 # Logging
-                # average over devices in ddp
-                if self.n_gpus > 1:
-                    loss = self.gather(loss).mean()
-                    wer = self.gather(wer).mean()
+                # average over devices in ddp in one collective, error counts are summed
+                logged = {"loss": loss, "grad_norm": grad_norm}
+                if compute_wer:
+                    logged["wer_counts"] = self.train_wer_counts
+                logged = self.reduce(logged, sum_keys = ["wer_counts"])
 
                 train_logs = {
-                    "loss": loss * self.gradient_accumulation_steps,
+                    "loss": logged["loss"] * self.gradient_accumulation_steps,
                     "lr": self.optimizer.param_groups[0]['lr'],
-                    "grad_norm": grad_norm,
-                    "wer": wer
+                    "grad_norm": logged["grad_norm"],
                 }
+                if compute_wer:
+                    train_logs["wer"] = self.compute_metric.compute(logged["wer_counts"])["wer"]
+                    self.train_wer_counts.zero_()
+                if self.measure_comm_time and self.backward_times["sync"] and self.backward_times["no_sync"]:
+                    train_logs["comm_saved_ms"] = self.comm_time_saved() * 1000
                 train_logs = {k: v.item() if hasattr(v, 'item') else v for k, v in train_logs.items()}
 
                 if self.rank == 0:
@@ -180,9 +231,9 @@ class Trainer(BaseTrainer):
         self.val_sampler.set_epoch(step)
         # init logs
         val_logs = {
-            "loss": 0,
-            "wer": 0
+            "loss": 0
         }
+        wer_counts = torch.zeros(4, dtype=torch.long)
 
         for batch in tqdm(self.val_dl, total = len(self.val_dl), disable = not self.rank == 0):
             with torch.no_grad():
@@ -190,10 +241,13 @@ class Trainer(BaseTrainer):
                     outputs = self.model(**batch)
 
             val_logs["loss"] += outputs.loss / len(self.val_dl)
-            val_logs["wer"] += torch.tensor(self.compute_metric(outputs.logits, batch['labels'])) / len(self.val_dl)
+            wer_counts += self.compute_metric.update(outputs.logits, batch['labels'])
 
-        # average over devices in ddp
-        if self.n_gpus > 1:
-            val_logs = {k: self.gather(v).mean() for k, v in val_logs.items()}
+        # average over devices in ddp in one collective, error counts are summed
+        val_logs["wer_counts"] = wer_counts
+        val_logs = self.reduce(val_logs, sum_keys = ["wer_counts"])
+        wer_counts = val_logs.pop("wer_counts")
         val_logs = {k: v.item() if hasattr(v, 'item') else v for k, v in val_logs.items()}
+        # corpus-level WER and CER of the validation set
+        val_logs.update(self.compute_metric.compute(wer_counts))
         return val_logs
@@ -0,0 +1,95 @@
+import hashlib
+import os
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Iterable, List
+from tqdm import tqdm
+from pathlib import Path
+from utils.feature import load_wav
+from utils.utils import import_from_path
+
+# The bounded parallel decoding is shared with the shard store of the pretraining pipeline
+bounded_map = import_from_path(
+    "pretraining_shard_store", Path(__file__).resolve().parents[2] / "Pretraining" / "shard_store.py"
+).bounded_map
+
+ARENA_DTYPES = {"int16": np.int16, "float16": np.float16, "float32": np.float32}
+INT16_SCALE = 32767
+
+
+def arena_path(arena_dir: str, paths: Iterable[str], sr: int, dtype: str = "int16") -> str:
+    """Path of the arena of a list of audio files, keyed by the files, their order, the sampling rate and the dtype."""
+    key = hashlib.sha1("\n".join([str(sr), dtype, *paths]).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(arena_dir, f"waveforms_{key}.bin")
+
+
+def encode(wav: np.ndarray, dtype: str) -> np.ndarray:
+    if dtype == "int16":
+        return np.clip(np.round(wav * INT16_SCALE), -INT16_SCALE - 1, INT16_SCALE).astype(np.int16)
+    return wav.astype(ARENA_DTYPES[dtype])
+
+
+def build_arena(paths: List[str], sr: int, path: str, dtype: str = "int16", num_workers: int = 1) -> None:
+    """
+    Decode every audio file with `load_wav` and append it to one contiguous file of `dtype` samples, with an index
+    holding the offset of every waveform. Files are decoded in parallel but written in order, so only a few
+    waveforms are held in memory at once. The index is written last and both files are renamed atomically, so an
+    interrupted build never leaves a usable but incomplete arena behind.
+    """
+    if dtype not in ARENA_DTYPES:
+        raise ValueError(f"Unsupported arena dtype {dtype}, expected one of {list(ARENA_DTYPES)}")
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    offsets = [0]
+    with open(path + ".tmp", "wb") as f, ProcessPoolExecutor(max_workers=num_workers) as executor:
+        decoded = bounded_map(executor, partial(load_wav, sr=sr), paths, window=4 * num_workers)
+        for wav in tqdm(decoded, total=len(paths)):
+            f.write(encode(wav, dtype).tobytes())
+            offsets.append(offsets[-1] + len(wav))
+    with open(path + ".index.tmp", "wb") as f:
+        np.savez(f, offsets=np.asarray(offsets, dtype=np.int64), dtype=dtype, sr=sr)
+    os.replace(path + ".tmp", path)
+    os.replace(path + ".index.tmp", path + ".index")
+
+
+def arena_exists(path: str) -> bool:
+    return os.path.exists(path) and os.path.exists(path + ".index")
+
+
+class WaveformArena:
+    """
+    Preloaded waveforms of a dataset, read as slices of one memory-mapped file built by `build_arena`. In /dev/shm
+    (the default of BaseDataset) the file lives in shared memory, elsewhere in the page cache, so the DDP processes
+    and their DataLoader workers all map the same pages instead of holding one copy of the dataset each. The file
+    stays until it is deleted and is reused by later runs on the same files.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        index = np.load(path + ".index")
+        self.offsets = index["offsets"]
+        self.dtype = str(index["dtype"])
+        self.sr = int(index["sr"])
+        self.data = None
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getstate__(self) -> dict:
+        # pickling a memmap copies its data, the workers reopen the mapping instead
+        return {**self.__dict__, "data": None}
+
+    def view(self, idx: int) -> np.ndarray:
+        # zero-copy slice of the mapping, in the dtype of the arena
+        if self.data is None:
+            self.data = np.memmap(self.path, dtype=ARENA_DTYPES[self.dtype], mode="r")
+        return self.data[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        wav = self.view(idx)
+        if self.dtype == "int16":
+            return wav.astype(np.float32) / INT16_SCALE
+        return wav.astype(np.float32, copy=False)
+
+    def size_mb(self) -> float:
+        return self.offsets[-1] * np.dtype(ARENA_DTYPES[self.dtype]).itemsize / 1024 ** 2
@@ -0,0 +1,79 @@
+import argparse
+import os
+import librosa
+import pandas as pd
+import soundfile as sf
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Tuple
+from tqdm import tqdm
+
+METADATA_SUFFIX = ".metadata.csv"
+METADATA_COLUMNS = ["path", "size", "mtime", "duration", "sr", "channels"]
+
+
+def metadata_path(manifest: str) -> str:
+    """The metadata cache lives next to the manifest, which is never modified."""
+    return manifest + METADATA_SUFFIX
+
+
+def probe(path: str) -> Tuple[float, int, int]:
+    """Duration, sampling rate and number of channels of an audio file, read from its header only."""
+    try:
+        info = sf.info(path)
+        return info.frames / info.samplerate, info.samplerate, info.channels
+    except RuntimeError:
+        # formats libsndfile cannot read, librosa falls back to audioread without decoding the samples, channels unknown (0)
+        return librosa.get_duration(filename=path), librosa.get_samplerate(path), 0
+
+
+def load_metadata(path: str) -> pd.DataFrame:
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=METADATA_COLUMNS).set_index("path")
+    return pd.read_csv(path).set_index("path")
+
+
+def update_metadata(manifest: str, paths: Iterable[str], num_workers: int = 1) -> pd.DataFrame:
+    """
+    Return the metadata of `paths`, indexed by path, from the cache of `manifest`. Only the files that are new or
+    whose size or modification time changed since the last update are probed, in parallel, and the cache is then
+    rewritten atomically. Entries of files that are not in `paths` are kept, so manifests sharing a cache (e.g.
+    rewritten splits) do not invalidate each other.
+    """
+    cache_path = metadata_path(manifest)
+    cache = load_metadata(cache_path)
+    paths = pd.Index(pd.unique(pd.Series(list(paths))))
+    stats = [os.stat(p) for p in paths]
+    current = pd.DataFrame(
+        {"size": [s.st_size for s in stats], "mtime": [s.st_mtime_ns for s in stats]}, index=paths
+    )
+
+    cached = cache.reindex(paths)
+    stale = paths[(cached["size"] != current["size"]) | (cached["mtime"] != current["mtime"])]
+    if len(stale) > 0:
+        print(f"Reading the headers of {len(stale)} new or changed audio files out of {len(paths)}")
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            probed = list(tqdm(executor.map(probe, stale, chunksize=64), total=len(stale)))
+        update = current.loc[stale].assign(
+            duration=[p[0] for p in probed], sr=[p[1] for p in probed], channels=[p[2] for p in probed]
+        )
+        cache = pd.concat([cache.drop(stale, errors="ignore"), update])
+        cache.index.name = "path"
+        tmp_path = cache_path + ".tmp"
+        cache.reset_index()[METADATA_COLUMNS].to_csv(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    return cache.loc[paths]
+
+
+if __name__ == '__main__':
+    # Build or update the metadata cache of manifests ahead of training
+    args = argparse.ArgumentParser(description='AUDIO METADATA CACHE')
+    args.add_argument('--manifests', nargs='+', required=True, help='CSV manifests with a path column')
+    args.add_argument('--delimiter', default=',', type=str, help='Delimiter of the manifests')
+    args.add_argument('--num_workers', default=os.cpu_count(), type=int, help='Number of processes reading headers')
+    args = args.parse_args()
+
+    for manifest in args.manifests:
+        metadata = update_metadata(manifest, pd.read_csv(manifest, delimiter=args.delimiter)['path'], args.num_workers)
+        print(f"{manifest}: {len(metadata)} files, {metadata['duration'].sum() / 3600:.2f} hours, "
+              f"sampling rates {sorted(metadata['sr'].unique())}")
@@ -1,19 +1,34 @@
-import evaluate
+import numpy as np
 import torch
 
+from typing import Dict
+from utils.wer import ctc_collapse, error_counts, error_rates
+
 class Metric:
+    """
+    Corpus-level WER and CER computed on token IDs, without decoding to strings. `update` returns the error counts
+    of a batch (word edits, reference words, character edits, reference characters), which can be summed across
+    batches and processes before `compute` turns them into one score.
+    """
     def __init__(self, processor):
         self.processor = processor
-        self.wer_metric = evaluate.load("wer") #JAY
-        # self.wer_metric = evaluate.load("cer") #JAY
-    def __call__(self, logits, labels):
-        preds = torch.argmax(logits, axis=-1)
+        self.pad_token_id = processor.tokenizer.pad_token_id
+        self.word_delimiter_token_id = processor.tokenizer.word_delimiter_token_id
+
+    def update(self, logits, labels) -> torch.Tensor:
+        preds = torch.argmax(logits, axis=-1).cpu().numpy()
+        labels = labels.cpu().numpy()
 
-        labels[labels == -100] = self.processor.tokenizer.pad_token_id
+        counts = np.zeros(4, dtype=np.int64)
+        for pred, label in zip(preds, labels):
+            # the predictions are CTC decoded, we do not want to group the tokens of the labels
+            label = label[(label != -100) & (label != self.pad_token_id)]
+            counts += error_counts(ctc_collapse(pred, self.pad_token_id), label, self.word_delimiter_token_id)
+        return torch.from_numpy(counts)
 
-        pred_strs = self.processor.batch_decode(preds)
-        # we do not want to group tokens when computing the metrics
-        label_strs = self.processor.batch_decode(labels, group_tokens=False)
+    def compute(self, counts) -> Dict[str, float]:
+        return error_rates(counts)
 
-        wer = self.wer_metric.compute(predictions=pred_strs, references=label_strs)
-        return wer
+    def __call__(self, logits, labels) -> float:
+        # WER of a single batch
+        return self.compute(self.update(logits, labels))["wer"]
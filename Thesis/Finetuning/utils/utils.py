@@ -1,4 +1,6 @@
 import importlib
+import importlib.util
+import sys
 import torch
 import numpy as np
 import random
@@ -27,3 +29,14 @@ def initialize_module(path: str, args: dict = None, initialize: bool = True):
             return class_or_function()
     else:
         return class_or_function
+
+def import_from_path(name: str, path):
+    # Import a module by its file path, without putting its directory on sys.path where it could shadow others, e.g.
+    # the modules shared with the pretraining pipeline
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,302 @@
+"""Benchmarks for the wav2vec2 pretraining script.
+
+Usage:
+    python benchmarks.py grads [--device cuda] [--steps 50]
+    python benchmarks.py cpu [--threads 4 8 16] [--steps 20]
+    python benchmarks.py dataloader --train_datasets train.csv [--num_workers 4 8 16] [--output_args_file dataloader.args]
+"""
+
+import argparse
+import itertools
+import os
+import time
+import numpy as np
+import torch
+
+from torch.utils.data import DataLoader
+from transformers import Wav2Vec2Config, Wav2Vec2FeatureExtractor, Wav2Vec2ForPreTraining
+from pretrain_wav2vec import (
+    CustomDataset,
+    DataCollatorForWav2Vec2Pretraining,
+    available_cores,
+    get_grad_norm,
+    multiply_grads,
+)
+
+
+def tiny_config() -> Wav2Vec2Config:
+    """A small Wav2Vec2 configuration that still has the structure of the base model."""
+    return Wav2Vec2Config(
+        hidden_size=256,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        intermediate_size=1024,
+        conv_dim=(128,) * 7,
+        do_stable_layer_norm=True,
+        feat_extract_norm="layer",
+        codevector_dim=128,
+        proj_codevector_dim=128,
+        num_codevectors_per_group=64,
+        mask_time_prob=0.65,
+    )
+
+
+def random_batches(model, num_batches, batch_size, seconds, sr=16000, seed=0):
+    """Padded and masked batches of random audio between half and the full duration."""
+    rng = np.random.default_rng(seed)
+    feature_extractor = Wav2Vec2FeatureExtractor(return_attention_mask=True)
+    collator = DataCollatorForWav2Vec2Pretraining(model=model, feature_extractor=feature_extractor)
+    batches = []
+    for _ in range(num_batches):
+        lengths = rng.integers(int(seconds * sr) // 2, int(seconds * sr), size=batch_size)
+        batches.append(collator([{"input_values": rng.standard_normal(n).astype(np.float32)} for n in lengths]))
+    return batches
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def legacy_multiply_grads(params, c):
+    """Per-parameter implementation `multiply_grads` replaced."""
+    for p in params:
+        if p.grad is not None:
+            if torch.is_tensor(c):
+                c = c.to(p.grad.device)
+            p.grad.data.mul_(c)
+
+
+def legacy_get_grad_norm(params, scale=1):
+    """Per-parameter implementation `get_grad_norm` replaced, with one `.item()` per parameter."""
+    total_norm = 0.0
+    for p in params:
+        if p.grad is not None:
+            param_norm = (p.grad.detach().data / scale).norm(2)
+            total_norm += param_norm.item() ** 2
+    total_norm = total_norm**0.5
+    return total_norm
+
+
+def benchmark_grads(args):
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = Wav2Vec2ForPreTraining(tiny_config()).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    batches = [
+        {k: v.to(device) for k, v in batch.items() if k != "sub_attention_mask"}
+        for batch in random_batches(model, 4, args.batch_size, args.seconds)
+    ]
+
+    results = {}
+    for name, multiply, grad_norm in [
+        ("per-parameter", legacy_multiply_grads, legacy_get_grad_norm),
+        ("foreach", multiply_grads, get_grad_norm),
+    ]:
+        step_time, grad_time = 0.0, 0.0
+        for step in range(args.warmup_steps + args.steps):
+            batch = batches[step % len(batches)]
+            synchronize(device)
+            start = time.perf_counter()
+            outputs = model(**batch)
+            outputs.loss.backward()
+            synchronize(device)
+            grads_start = time.perf_counter()
+            multiply(model.parameters(), 1 / batch["mask_time_indices"].sum())
+            # reading the norm on every step is the worst case of the training loop
+            float(grad_norm(model.parameters(), 1))
+            grads_end = time.perf_counter()
+            optimizer.step()
+            optimizer.zero_grad()
+            synchronize(device)
+            if step >= args.warmup_steps:
+                step_time += time.perf_counter() - start
+                grad_time += grads_end - grads_start
+        results[name] = (step_time / args.steps * 1000, grad_time / args.steps * 1000)
+
+    num_params = sum(1 for _ in model.parameters())
+    print(f"Wav2Vec2ForPreTraining with {num_params} parameter tensors on {device}, batch size {args.batch_size}")
+    for name, (step_ms, grad_ms) in results.items():
+        print(f"{name:>14}: {step_ms:8.2f} ms/step, of which {grad_ms:7.2f} ms grad scaling and norm")
+
+
+def benchmark_cpu(args):
+    """Training throughput on CPU for every combination of intra-op threads, bf16 autocast and torch.compile."""
+    batches = None
+    results = []
+    for num_threads in args.threads or [available_cores()]:
+        torch.set_num_threads(num_threads)
+        for bf16 in [False, True] if args.bf16 else [False]:
+            for compile_model in [False, True] if args.compile else [False]:
+                torch.manual_seed(0)
+                model = Wav2Vec2ForPreTraining(tiny_config())
+                if compile_model:
+                    model.forward = torch.compile(model.forward)
+                optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+                if batches is None:
+                    batches = [
+                        {k: v for k, v in batch.items() if k != "sub_attention_mask"}
+                        for batch in random_batches(model, 4, args.batch_size, args.seconds)
+                    ]
+                elapsed, audio_seconds = 0.0, 0.0
+                for step in range(args.warmup_steps + args.steps):
+                    batch = batches[step % len(batches)]
+                    start = time.perf_counter()
+                    with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=bf16):
+                        outputs = model(**batch)
+                    outputs.loss.backward()
+                    multiply_grads(model.parameters(), 1 / batch["mask_time_indices"].sum())
+                    optimizer.step()
+                    optimizer.zero_grad()
+                    if step >= args.warmup_steps:
+                        elapsed += time.perf_counter() - start
+                        audio_seconds += batch["attention_mask"].sum().item() / 16000
+                results.append((num_threads, bf16, compile_model, args.steps * args.batch_size / elapsed,
+                                audio_seconds / elapsed))
+
+    print(f"Wav2Vec2ForPreTraining (tiny) on CPU with {available_cores()} cores, batch size {args.batch_size}")
+    for num_threads, bf16, compile_model, samples, audio in results:
+        print(f"threads {num_threads:>3} | bf16 {str(bf16):>5} | compile {str(compile_model):>5} | "
+              f"{samples:7.2f} samples/s | {audio:7.1f} audio s/s")
+
+
+def child_pids(pid):
+    pids = []
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    return pids + [grandchild for child in pids for grandchild in child_pids(child)]
+
+
+def process_tree_pss_mb():
+    """Proportional set size of this process and its DataLoader workers, so shared pages are only counted once."""
+    total = 0
+    for pid in [os.getpid()] + child_pids(os.getpid()):
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                total += sum(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+        except FileNotFoundError:
+            # the worker exited in the meantime
+            pass
+    return total / 1024
+
+
+def benchmark_dataloader(args):
+    """Batches per second and memory of the pretraining DataLoader without a model, over a grid of settings."""
+    if args.model_name_or_path is not None:
+        config = Wav2Vec2Config.from_pretrained(args.model_name_or_path)
+        feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(args.model_name_or_path)
+    else:
+        config, feature_extractor = tiny_config(), Wav2Vec2FeatureExtractor(return_attention_mask=True)
+    # the collator only needs the configuration and the output length formula of the model
+    collator = DataCollatorForWav2Vec2Pretraining(model=Wav2Vec2ForPreTraining(config), feature_extractor=feature_extractor)
+    dataset = CustomDataset(
+        args.train_datasets,
+        sep=args.separator,
+        audio_column_name=args.audio_column_name,
+        duration_column_name=args.duration_column_name,
+        sr=16000,
+        min_duration=args.min_duration_in_seconds,
+        max_duration=args.max_duration_in_seconds,
+        shard_dir=args.shard_dir,
+    )
+    print(f"{len(dataset)} examples, {available_cores()} cores")
+
+    results = []
+    for num_workers, prefetch_factor, batch_size in itertools.product(
+        args.num_workers, args.prefetch_factors, args.batch_sizes
+    ):
+        if num_workers == 0 and prefetch_factor != args.prefetch_factors[0]:
+            # the prefetch factor has no effect without workers
+            continue
+        loader_kwargs = {"prefetch_factor": prefetch_factor} if num_workers > 0 else {}
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, collate_fn=collator,
+                            num_workers=num_workers, **loader_kwargs)
+        iterator = iter(loader)
+        num_batches = min(args.num_batches, len(loader) - args.warmup_batches)
+        if num_batches < 1:
+            raise ValueError(f"{len(loader)} batches of size {batch_size} do not cover {args.warmup_batches} warmup batches")
+        for _ in range(args.warmup_batches):
+            next(iterator)
+        start = time.perf_counter()
+        for _ in range(num_batches):
+            next(iterator)
+        elapsed = time.perf_counter() - start
+        memory = process_tree_pss_mb()
+        del iterator
+        results.append({
+            "num_workers": num_workers,
+            "prefetch_factor": prefetch_factor,
+            "batch_size": batch_size,
+            "batches_per_sec": num_batches / elapsed,
+            "samples_per_sec": num_batches * batch_size / elapsed,
+            "memory_mb": memory,
+        })
+        print("workers {num_workers:>3} | prefetch {prefetch_factor:>3} | batch size {batch_size:>4} | "
+              "{batches_per_sec:8.2f} batches/s | {samples_per_sec:9.1f} samples/s | {memory_mb:8.0f} MB".format(
+                  **results[-1]))
+
+    candidates = [r for r in results if args.max_memory_mb is None or r["memory_mb"] <= args.max_memory_mb]
+    if not candidates:
+        print(f"No setting stays below {args.max_memory_mb} MB")
+        return
+    best = max(candidates, key=lambda r: r["samples_per_sec"])
+    print("Best: {num_workers} workers, prefetch factor {prefetch_factor}, batch size {batch_size}".format(**best))
+    if args.output_args_file is not None:
+        # one token per line, read by pretrain_wav2vec.py with `@<file>`
+        lines = [
+            "--dataloader_num_workers", str(best["num_workers"]),
+            "--dataloader_prefetch_factor", str(best["prefetch_factor"]),
+        ]
+        if len(args.batch_sizes) > 1:
+            lines += ["--per_device_train_batch_size", str(best["batch_size"])]
+        with open(args.output_args_file, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"Wrote the settings to {args.output_args_file}, pass @{args.output_args_file} to pretrain_wav2vec.py")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for wav2vec2 pretraining")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    grads = subparsers.add_parser("grads", help="Step time of the gradient scaling and grad norm utilities.")
+    grads.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    grads.add_argument("--batch_size", type=int, default=4)
+    grads.add_argument("--seconds", type=float, default=5.0)
+    grads.add_argument("--steps", type=int, default=50)
+    grads.add_argument("--warmup_steps", type=int, default=5)
+    grads.set_defaults(func=benchmark_grads)
+
+    cpu = subparsers.add_parser("cpu", help="Training throughput on CPU with thread, autocast and compile settings.")
+    cpu.add_argument("--threads", type=int, nargs="*", default=None, help="Intra-op thread counts to compare.")
+    cpu.add_argument("--bf16", action="store_true", help="Also measure bfloat16 autocast.")
+    cpu.add_argument("--compile", action="store_true", help="Also measure torch.compile.")
+    cpu.add_argument("--batch_size", type=int, default=4)
+    cpu.add_argument("--seconds", type=float, default=5.0)
+    cpu.add_argument("--steps", type=int, default=20)
+    cpu.add_argument("--warmup_steps", type=int, default=3)
+    cpu.set_defaults(func=benchmark_cpu)
+
+    dataloader = subparsers.add_parser("dataloader", help="Throughput and memory of the DataLoader without a model.")
+    dataloader.add_argument("--train_datasets", nargs="+", type=str, required=True)
+    dataloader.add_argument("--separator", type=str, default=None)
+    dataloader.add_argument("--audio_column_name", type=str, default="path")
+    dataloader.add_argument("--duration_column_name", type=str, default="duration")
+    dataloader.add_argument("--min_duration_in_seconds", type=float, default=3.0)
+    dataloader.add_argument("--max_duration_in_seconds", type=float, default=5.0)
+    dataloader.add_argument("--shard_dir", type=str, default=None)
+    dataloader.add_argument("--model_name_or_path", type=str, default=None,
+                            help="Model whose config and feature extractor the collator uses, defaults to the tiny config.")
+    dataloader.add_argument("--num_workers", type=int, nargs="+", default=[4, 8, 16])
+    dataloader.add_argument("--prefetch_factors", type=int, nargs="+", default=[2, 4, 16])
+    dataloader.add_argument("--batch_sizes", type=int, nargs="+", default=[8])
+    dataloader.add_argument("--num_batches", type=int, default=100)
+    dataloader.add_argument("--warmup_batches", type=int, default=10)
+    dataloader.add_argument("--max_memory_mb", type=float, default=None,
+                            help="Only consider settings whose memory stays below this bound.")
+    dataloader.add_argument("--output_args_file", type=str, default=None,
+                            help="File to write the best settings to, as arguments of pretrain_wav2vec.py.")
+    dataloader.set_defaults(func=benchmark_dataloader)
+
+    args = parser.parse_args()
+    args.func(args)
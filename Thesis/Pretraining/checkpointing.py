@@ -0,0 +1,156 @@
+"""Asynchronous checkpointing for wav2vec2 pretraining.
+
+`AsyncCheckpointWriter.save` snapshots the model, optimizer, scheduler and RNG states to CPU memory on the training
+thread and writes them to `<output_dir>/checkpoint-<completed_steps>` on a background thread, together with the
+exported model in `<output_dir>/saved_model/epoch_<epoch>`. Every file is written under a temporary name and renamed
+once complete, and `latest_checkpoint.pt` is only replaced after the whole checkpoint is on disk, so a crash during a
+write always leaves the previous checkpoint resumable. `load_checkpoint` restores such a checkpoint.
+"""
+
+import os
+import random
+import shutil
+import threading
+import numpy as np
+import torch
+
+from glob import glob
+from typing import Any, Dict, Optional
+
+LATEST_CHECKPOINT_NAME = "latest_checkpoint.pt"
+
+
+def to_cpu(obj: Any) -> Any:
+    """Copy all tensors of a (nested) state dict to CPU memory, asynchronously from pinned memory on GPUs."""
+    if torch.is_tensor(obj):
+        if obj.device.type == "cuda":
+            copy = torch.empty(obj.shape, dtype=obj.dtype, device="cpu", pin_memory=True)
+            return copy.copy_(obj.detach(), non_blocking=True)
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def rng_states() -> Dict[str, Any]:
+    states = {
+        "random_state": random.getstate(),
+        "numpy_random_seed": np.random.get_state(),
+        "torch_manual_seed": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states["torch_cuda_manual_seed"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: Dict[str, Any]) -> None:
+    random.setstate(states["random_state"])
+    np.random.set_state(states["numpy_random_seed"])
+    torch.set_rng_state(states["torch_manual_seed"])
+    if torch.cuda.is_available() and "torch_cuda_manual_seed" in states:
+        torch.cuda.set_rng_state_all(states["torch_cuda_manual_seed"][: torch.cuda.device_count()])
+
+
+def atomic_save(obj: Any, path: str) -> None:
+    torch.save(obj, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+def replace_dir(src: str, dst: str) -> None:
+    """Move the finished directory `src` to `dst`, replacing an existing `dst`."""
+    if os.path.exists(dst):
+        old = dst + ".old"
+        shutil.rmtree(old, ignore_errors=True)
+        os.replace(dst, old)
+        os.replace(src, dst)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.replace(src, dst)
+
+
+class AsyncCheckpointWriter:
+    def __init__(self, accelerator, output_dir: str):
+        self.accelerator = accelerator
+        self.output_dir = output_dir
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    def wait(self) -> None:
+        """Block until the checkpoint being written is on disk, re-raising any error of the writer thread."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing the previous checkpoint failed") from error
+
+    def save(self, model, optimizer, lr_scheduler, feature_extractor, epoch: int, completed_steps: int,
+             extra: Optional[Dict[str, Any]] = None) -> None:
+        """Snapshot the training state and persist it in the background. Has to be called on all processes."""
+        accelerator = self.accelerator
+        # only one checkpoint is in flight at a time
+        self.wait()
+
+        state_dir = f"checkpoint-{completed_steps}"
+        path = os.path.join(self.output_dir, state_dir)
+        os.makedirs(path, exist_ok=True)
+        atomic_save(rng_states(), os.path.join(path, f"random_states_{accelerator.process_index}.pkl"))
+        # may be a collective call, e.g. for sharded optimizer states
+        optimizer_state = optimizer.state_dict()
+        accelerator.wait_for_everyone()
+        if not accelerator.is_main_process:
+            return
+
+        unwrapped_model = accelerator.unwrap_model(model)
+        snapshot = {
+            "model": to_cpu(unwrapped_model.state_dict()),
+            "optimizer": to_cpu(optimizer_state),
+            "lr_scheduler": to_cpu(lr_scheduler.state_dict()),
+        }
+        if getattr(accelerator, "scaler", None) is not None:
+            snapshot["scaler"] = accelerator.scaler.state_dict()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        checkpoint = {"completed_steps": completed_steps, "epoch": epoch, "state_dir": state_dir, **(extra or {})}
+        self._thread = threading.Thread(
+            target=self._write, args=(snapshot, unwrapped_model, feature_extractor, checkpoint), daemon=False
+        )
+        self._thread.start()
+
+    def _write(self, snapshot, unwrapped_model, feature_extractor, checkpoint) -> None:
+        try:
+            path = os.path.join(self.output_dir, checkpoint["state_dir"])
+            for name, state in snapshot.items():
+                atomic_save(state, os.path.join(path, f"{name}.bin"))
+
+            export_dir = os.path.join(self.output_dir, "saved_model", f"epoch_{checkpoint['epoch']}")
+            unwrapped_model.save_pretrained(export_dir + ".tmp", state_dict=snapshot["model"])
+            feature_extractor.save_pretrained(export_dir + ".tmp")
+            replace_dir(export_dir + ".tmp", export_dir)
+
+            # point the resume file to the new checkpoint only once it is complete
+            atomic_save(checkpoint, os.path.join(self.output_dir, LATEST_CHECKPOINT_NAME))
+            for old_dir in glob(os.path.join(self.output_dir, "checkpoint-*")):
+                step = os.path.basename(old_dir)[len("checkpoint-"):]
+                if step.isdigit() and int(step) < checkpoint["completed_steps"]:
+                    shutil.rmtree(old_dir, ignore_errors=True)
+        except BaseException as error:
+            self._error = error
+
+
+def load_checkpoint(accelerator, state_dir: str, model, optimizer, lr_scheduler) -> None:
+    """Restore a checkpoint written by `AsyncCheckpointWriter` on the current process."""
+    accelerator.unwrap_model(model).load_state_dict(torch.load(os.path.join(state_dir, "model.bin"), map_location="cpu"))
+    optimizer.load_state_dict(torch.load(os.path.join(state_dir, "optimizer.bin"), map_location="cpu"))
+    # the scheduler, scaler and RNG states hold plain Python and NumPy objects that the default weights_only loading of
+    # torch >= 2.6 rejects, they are trusted files written by this run
+    lr_scheduler.load_state_dict(torch.load(os.path.join(state_dir, "lr_scheduler.bin"), weights_only=False))
+    scaler_path = os.path.join(state_dir, "scaler.bin")
+    if getattr(accelerator, "scaler", None) is not None and os.path.exists(scaler_path):
+        accelerator.scaler.load_state_dict(torch.load(scaler_path, weights_only=False))
+    rng_path = os.path.join(state_dir, f"random_states_{accelerator.process_index}.pkl")
+    if os.path.exists(rng_path):
+        set_rng_states(torch.load(rng_path, weights_only=False))
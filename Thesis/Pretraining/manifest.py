@@ -0,0 +1,98 @@
+import argparse
+import numpy as np
+import pandas as pd
+
+from typing import Dict, List, Optional, Union
+
+
+class CompactManifest:
+    """
+    Read-only, array-backed replacement for a manifest DataFrame in datasets used by forked DataLoader workers.
+    String columns are stored as one UTF-8 byte buffer plus an offsets array, numeric columns as NumPy arrays, so
+    reading an item does not touch the reference counts of millions of Python objects and the pages shared with
+    the parent process are never copied on write.
+    """
+    def __init__(self, df: pd.DataFrame, columns: Optional[List[str]] = None):
+        columns = list(df.columns) if columns is None else columns
+        self.numeric: Dict[str, np.ndarray] = {}
+        self.strings: Dict[str, np.ndarray] = {}
+        self.offsets: Dict[str, np.ndarray] = {}
+        for column in columns:
+            values = df[column]
+            if pd.api.types.is_numeric_dtype(values):
+                self.numeric[column] = values.to_numpy()
+            else:
+                encoded = [b"" if pd.isna(v) else str(v).encode("utf-8") for v in values]
+                self.offsets[column] = np.concatenate([[0], np.cumsum([len(v) for v in encoded], dtype=np.int64)])
+                self.strings[column] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        self.columns = columns
+        self.length = len(df)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __contains__(self, column: str) -> bool:
+        return column in self.columns
+
+    def get(self, column: str, idx: int) -> Union[str, float, int]:
+        if column in self.numeric:
+            return self.numeric[column][idx]
+        start, end = self.offsets[column][idx], self.offsets[column][idx + 1]
+        return self.strings[column][start:end].tobytes().decode("utf-8")
+
+    def column(self, column: str) -> Union[np.ndarray, List[str]]:
+        if column in self.numeric:
+            return self.numeric[column]
+        return [self.get(column, idx) for idx in range(self.length)]
+
+    def row(self, idx: int) -> Dict[str, Union[str, float, int]]:
+        return {column: self.get(column, idx) for column in self.columns}
+
+
+def private_memory_mb() -> float:
+    """Memory private to the calling process (pages it does not share with its parent anymore), Linux only."""
+    with open("/proc/self/smaps_rollup") as f:
+        fields = dict(line.split(":", 1) for line in f if line.startswith("Private_"))
+    return sum(int(v.split()[0]) for v in fields.values()) / 1024
+
+
+if __name__ == '__main__':
+    # Memory benchmark: private memory of DataLoader workers reading a large manifest, DataFrame vs CompactManifest
+    import torch
+
+    args = argparse.ArgumentParser(description='MANIFEST MEMORY BENCHMARK')
+    args.add_argument('--rows', default=2_000_000, type=int, help='Number of rows of the synthetic manifest')
+    args.add_argument('--workers', default=8, type=int, help='Number of DataLoader workers')
+    args.add_argument('--batch_size', default=256, type=int, help='Batch size of the DataLoader')
+    args = args.parse_args()
+
+    class ManifestReader(torch.utils.data.Dataset):
+        def __init__(self, data):
+            self.data = data
+
+        def __len__(self) -> int:
+            return len(self.data)
+
+        def __getitem__(self, idx) -> tuple:
+            if isinstance(self.data, CompactManifest):
+                path, transcript = self.data.get('path', idx), self.data.get('transcript', idx)
+            else:
+                item = self.data.iloc[idx]
+                path, transcript = item['path'], item['transcript']
+            return len(path) + len(transcript), private_memory_mb()
+
+    df = pd.DataFrame({
+        'path': [f'/data/corpus/speaker_{i % 1000:04d}/utterance_{i:09d}.wav' for i in range(args.rows)],
+        'transcript': [f'transcript number {i} of the synthetic manifest' for i in range(args.rows)],
+        'duration': np.random.uniform(1, 15, args.rows),
+    })
+    for name, data in [('DataFrame', df), ('CompactManifest', CompactManifest(df))]:
+        loader = torch.utils.data.DataLoader(
+            ManifestReader(data), batch_size=args.batch_size, shuffle=True, num_workers=args.workers,
+            collate_fn=lambda items: max(memory for _, memory in items))
+        checkpoints = {int(len(loader) * q) for q in (0, 0.25, 0.5, 0.75)} | {len(loader) - 1}
+        report = []
+        for step, memory in enumerate(loader):
+            if step in checkpoints:
+                report.append(f'{100 * step // len(loader)}%: {memory:.0f} MB')
+        print(f'{name:>16} | max private worker memory at ' + ', '.join(report))
@@ -0,0 +1,146 @@
+"""Batched torch implementations of the wav2vec2 span masking and negative sampling.
+
+Drop-in replacements for `_compute_mask_indices` and `_sample_negative_indices` from
+`transformers.models.wav2vec2.modeling_wav2vec2`, which loop over the examples of a batch in NumPy. These functions
+handle the whole batch with a few tensor operations, accept a `torch.Generator` for reproducible sampling and can run
+on any device, e.g. on the GPU after the batch has been transferred.
+
+Running this file compares the masking and negative statistics with the transformers implementation:
+    python masking.py
+"""
+
+import torch
+
+from typing import Optional, Tuple
+
+
+def compute_mask_indices(
+    shape: Tuple[int, int],
+    mask_prob: float,
+    mask_length: int,
+    attention_mask: Optional[torch.Tensor] = None,
+    min_masks: int = 0,
+    generator: Optional[torch.Generator] = None,
+    device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """
+    Sample spans of `mask_length` frames to mask, as in `_compute_mask_indices` (https://arxiv.org/abs/2006.11477).
+    Every example gets `mask_prob * input_length / mask_length` spans (stochastically rounded) with start positions
+    drawn without replacement; spans may overlap. Returns a boolean tensor of `shape`.
+    """
+    batch_size, sequence_length = shape
+    if mask_length < 1:
+        raise ValueError("`mask_length` has to be bigger than 0.")
+    if mask_length > sequence_length:
+        raise ValueError(
+            f"`mask_length` has to be smaller than `sequence_length`, but got `mask_length`: {mask_length}"
+            f" and `sequence_length`: {sequence_length}`"
+        )
+    if attention_mask is not None:
+        device = attention_mask.device
+        input_lengths = attention_mask.sum(-1).long()
+    else:
+        input_lengths = torch.full((batch_size,), sequence_length, dtype=torch.long, device=device)
+
+    # upper bound of the number of spans, known on the host so no synchronization is needed
+    max_num_spans = min(max(int(mask_prob * sequence_length / mask_length + 1), min_masks), sequence_length // mask_length)
+    mask = torch.zeros(batch_size, sequence_length + 1, dtype=torch.bool, device=device)
+    if max_num_spans == 0:
+        return mask[:, :sequence_length]
+
+    epsilon = torch.rand(batch_size, generator=generator, device=device)
+    num_spans = (mask_prob * input_lengths / mask_length + epsilon).long().clamp(min=min_masks)
+    num_spans = num_spans.clamp(max=sequence_length // mask_length)
+    num_starts = (input_lengths - (mask_length - 1)).clamp(min=0)
+    num_spans = torch.minimum(num_spans, num_starts)
+
+    # random scores for all valid start positions; the top `num_spans` form a uniform sample without replacement
+    num_positions = sequence_length - mask_length + 1
+    scores = torch.rand(batch_size, num_positions, generator=generator, device=device)
+    scores.masked_fill_(torch.arange(num_positions, device=device)[None, :] >= num_starts[:, None], -1.0)
+    span_starts = scores.topk(max_num_spans, dim=-1).indices
+    span_is_used = torch.arange(max_num_spans, device=device)[None, :] < num_spans[:, None]
+
+    indices = span_starts[:, :, None] + torch.arange(mask_length, device=device)
+    indices = indices.masked_fill(~span_is_used[:, :, None], sequence_length).reshape(batch_size, -1)
+    # unused spans are scattered into the extra last column, which is dropped
+    mask.scatter_(1, indices, True)
+    return mask[:, :sequence_length]
+
+
+def sample_negative_indices(
+    features_shape: Tuple[int, int],
+    num_negatives: int,
+    mask_time_indices: Optional[torch.Tensor] = None,
+    generator: Optional[torch.Generator] = None,
+    device: Optional[torch.device] = None,
+) -> torch.Tensor:
+    """
+    Sample `num_negatives` distractors for every masked frame, as in `_sample_negative_indices`: distractors are drawn
+    uniformly from the other masked frames of the same example and returned as indices into the flattened
+    (batch_size * sequence_length) features. Unmasked frames get the index of the first frame of their example.
+    """
+    batch_size, sequence_length = features_shape
+    if mask_time_indices is not None:
+        mask = mask_time_indices.bool()
+        device = mask.device
+    else:
+        mask = torch.ones(features_shape, dtype=torch.bool, device=device)
+
+    num_masked = mask.sum(-1, keepdim=True)
+    # rank of every masked frame among the masked frames of its example
+    rank = mask.long().cumsum(-1) - 1
+    # positions of the masked frames in ascending order, followed by the unmasked ones
+    masked_positions = torch.sort((~mask).to(torch.uint8), dim=-1, stable=True).indices
+
+    num_candidates = (num_masked - 1).clamp(min=1)
+    sampled = torch.rand(batch_size, sequence_length, num_negatives, generator=generator, device=device)
+    sampled = (sampled * num_candidates[:, :, None]).long()
+    # skip the positive frame itself, but keep the distribution uniform
+    sampled += (sampled >= rank[:, :, None]).long()
+    sampled = torch.minimum(sampled, (num_masked - 1).clamp(min=0)[:, :, None])
+
+    negatives = torch.gather(masked_positions, 1, sampled.reshape(batch_size, -1)).reshape(sampled.shape)
+    negatives = negatives.masked_fill(~mask[:, :, None], 0)
+    return negatives + (torch.arange(batch_size, device=device) * sequence_length)[:, None, None]
+
+
+if __name__ == "__main__":
+    import numpy as np
+    from transformers.models.wav2vec2.modeling_wav2vec2 import _compute_mask_indices, _sample_negative_indices
+
+    batch_size, sequence_length, num_negatives, trials = 16, 249, 100, 200
+    generator = torch.Generator().manual_seed(0)
+    np.random.seed(0)
+    for mask_prob, mask_length in [(0.05, 10), (0.65, 10), (0.2, 5)]:
+        stats = {"transformers": [], "torch": []}
+        for _ in range(trials):
+            lengths = torch.randint(sequence_length // 2, sequence_length + 1, (batch_size,), generator=generator)
+            attention_mask = torch.arange(sequence_length)[None, :] < lengths[:, None]
+            reference = _compute_mask_indices(
+                (batch_size, sequence_length), mask_prob, mask_length, attention_mask=attention_mask.long()
+            )
+            stats["transformers"].append(reference.sum(-1) / lengths.numpy())
+            mask = compute_mask_indices(
+                (batch_size, sequence_length), mask_prob, mask_length, attention_mask=attention_mask, generator=generator
+            )
+            assert not mask[~attention_mask].any(), "masked a padded frame"
+            stats["torch"].append((mask.sum(-1) / lengths).numpy())
+        print(f"mask_time_prob={mask_prob}, mask_time_length={mask_length}")
+        for name, fractions in stats.items():
+            fractions = np.concatenate(fractions)
+            print(f"    {name:>12}: masked fraction mean {fractions.mean():.4f}, std {fractions.std():.4f}")
+
+    # negatives: same example, masked, never the positive and uniform over the candidates
+    mask = compute_mask_indices((batch_size, sequence_length), 0.65, 10, generator=generator)
+    negatives = sample_negative_indices((batch_size, sequence_length), num_negatives, mask, generator=generator)
+    reference = _sample_negative_indices((batch_size, sequence_length), num_negatives, mask.numpy())
+    flat_mask = mask.reshape(-1)
+    positives = torch.arange(batch_size * sequence_length).reshape(batch_size, sequence_length, 1)
+    for name, sampled in [("transformers", torch.from_numpy(reference).long()), ("torch", negatives)]:
+        sampled_masked = sampled[mask]
+        assert flat_mask[sampled_masked].all(), f"{name}: sampled an unmasked frame"
+        assert (sampled_masked // sequence_length == positives[mask] // sequence_length).all(), f"{name}: crossed examples"
+        assert (sampled_masked != positives[mask]).all(), f"{name}: sampled the positive"
+        counts = torch.bincount(sampled_masked.reshape(-1), minlength=batch_size * sequence_length)[flat_mask].float()
+        print(f"negatives {name:>12}: per-frame count mean {counts.mean():.1f}, relative std {counts.std() / counts.mean():.4f}")
@@ -0,0 +1,82 @@
+"""Deferred logging of training metrics without host synchronizations in the training loop.
+
+`MetricAccumulator` sums metrics in device tensors across steps. `flush` reduces all summed metrics across processes in
+one packed collective and starts a non-blocking copy to the host; `completed` returns the flushed values once that
+copy has finished, so the training stream is never stalled by `.item()` calls. Host values (learning rate, gumbel
+temperature, ...) are stored next to the device values of the same flush without being wrapped in tensors.
+"""
+
+import torch
+
+from collections import deque
+from typing import Any, Dict, Iterator, List, Tuple, Union
+
+
+class MetricAccumulator:
+    def __init__(self, accelerator):
+        self.accelerator = accelerator
+        self.device = accelerator.device
+        # float64 keeps summed counts exact in the packed tensor; MPS does not support it
+        self.dtype = torch.float32 if self.device.type == "mps" else torch.float64
+        self.sums: Dict[str, torch.Tensor] = {}
+        self.reduced: Dict[str, bool] = {}
+        self.scalar: Dict[str, bool] = {}
+        self.host: Dict[str, Any] = {}
+        self.pending = deque()
+
+    def add(self, name: str, value: torch.Tensor, reduce: bool = True) -> None:
+        """Adds a device scalar or vector to the sum of `name`; `reduce` sums it across processes at flush time."""
+        if name in self.sums:
+            self.sums[name] += value.detach().to(self.dtype).reshape(-1)
+        else:
+            self.sums[name] = value.detach().to(self.dtype).reshape(-1).clone()
+            self.reduced[name] = reduce
+            # one-element tensors (e.g. norms computed with the shape-[1] scale of the GradScaler) are logged as scalars
+            self.scalar[name] = value.numel() == 1
+
+    def discard(self, name: str) -> None:
+        """Drops the sum of `name` accumulated since the last flush, e.g. when the window it is measured over restarts."""
+        self.sums.pop(name, None)
+        self.reduced.pop(name, None)
+        self.scalar.pop(name, None)
+
+    def add_host(self, name: str, value: Any) -> None:
+        """Stores a host value, reported unchanged with the next flush."""
+        self.host[name] = value
+
+    def flush(self, step: int) -> None:
+        """Reduces the sums across processes in one collective and copies them to the host asynchronously, then resets.
+        Has to be called on all processes."""
+        names = sorted(self.sums, key=lambda name: not self.reduced[name])
+        layout: List[Tuple[str, int, bool]] = [(name, self.sums[name].numel(), self.scalar[name]) for name in names]
+        num_reduced = sum(self.sums[name].numel() for name in names if self.reduced[name])
+        packed = torch.cat([self.sums[name] for name in names]) if names else torch.zeros(0, dtype=self.dtype)
+        if num_reduced > 0 and self.accelerator.num_processes > 1:
+            packed = torch.cat([self.accelerator.reduce(packed[:num_reduced], reduction="sum"), packed[num_reduced:]])
+
+        event = None
+        if packed.device.type == "cuda":
+            host = torch.empty(packed.shape, dtype=packed.dtype, pin_memory=True)
+            host.copy_(packed, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host = packed.cpu()
+        self.pending.append((step, layout, host, event, self.host))
+        self.sums, self.reduced, self.scalar, self.host = {}, {}, {}, {}
+
+    def completed(self, block: bool = False) -> Iterator[Tuple[int, Dict[str, Union[float, List[float], Any]]]]:
+        """Yields `(step, values)` of the flushes whose copy has finished, in order; `block` waits for all of them."""
+        while self.pending:
+            step, layout, host, event, host_values = self.pending[0]
+            if event is not None:
+                if not block and not event.query():
+                    return
+                event.synchronize()
+            self.pending.popleft()
+            values, offset = dict(host_values), 0
+            for name, size, scalar in layout:
+                chunk = host[offset : offset + size].tolist()
+                values[name] = chunk[0] if scalar else chunk
+                offset += size
+            yield step, values
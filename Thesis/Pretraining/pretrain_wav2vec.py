@@ -1,26 +1,29 @@
 import argparse
+import itertools
 import math
 import os
+import warnings
 import pandas as pd
 import numpy as np
 import soundfile as sf
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from pathlib import Path
 from typing import Dict, List, Optional, Union
 from tqdm import tqdm
 
 import datasets
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Subset, get_worker_info
 from datasets import DatasetDict, concatenate_datasets, load_dataset, IterableDatasetDict
 from torch.utils.data.dataloader import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm.auto import tqdm
 
 import transformers
-from accelerate import Accelerator
+from accelerate import Accelerator, skip_first_batches
 from accelerate.logging import get_logger
+from accelerate.utils import send_to_device
 from huggingface_hub import Repository, login
 from transformers import (
     SchedulerType,
@@ -30,14 +33,24 @@ from transformers import (
     get_scheduler,
     set_seed,
 )
-from transformers.models.wav2vec2.modeling_wav2vec2 import _compute_mask_indices, _sample_negative_indices
 from transformers.utils import get_full_repo_name
+
+from manifest import CompactManifest
+from masking import compute_mask_indices, sample_negative_indices
+from samplers import BucketBatchSampler, DurationBudgetBatchSampler, WeightedSourceBatchSampler, source_probabilities
+from shard_store import ShardStore
+from checkpointing import AsyncCheckpointWriter, load_checkpoint
+from timing import StepTimer
+from metrics import MetricAccumulator
+from sharding import create_optimizer, expected_state_mb, optimizer_state_mb
 import time
 
 logger = get_logger(__name__)
 
 def parse_args():
-    parser = argparse.ArgumentParser(description="Finetune a transformers model on a text classification task")
+    # arguments can also be read from a file, e.g. `@dataloader.args` written by `benchmarks.py dataloader`
+    parser = argparse.ArgumentParser(description="Finetune a transformers model on a text classification task",
+                                     fromfile_prefix_chars="@")
     parser.add_argument(
         "--train_datasets",
         nargs="+",
@@ -45,6 +58,32 @@ def parse_args():
         default=None,
         help="The name of the dataset to use (via the datasets library).",
     )
+    parser.add_argument(
+        "--train_dataset_weights",
+        nargs="+",
+        type=float,
+        default=None,
+        help=(
+            "Sampling weight of every dataset in `train_datasets`. If set (or if `source_temperature` is set), the"
+            " datasets are interleaved by these weights instead of concatenated. With `--streaming` every dataset is"
+            " only read once it is drawn, this requires the weights and `mixing_epoch_size`."
+        ),
+    )
+    parser.add_argument(
+        "--source_temperature",
+        type=float,
+        default=None,
+        help=(
+            "Temperature applied to the dataset weights (the dataset sizes if `train_dataset_weights` is not given):"
+            " datasets are sampled proportionally to weight ** (1 / temperature)."
+        ),
+    )
+    parser.add_argument(
+        "--mixing_epoch_size",
+        type=int,
+        default=None,
+        help="Number of training examples per epoch when interleaving datasets. Defaults to the total size.",
+    )
     parser.add_argument(
         "--val_datasets",
         nargs="+",
@@ -66,12 +105,31 @@ def parse_args():
         help="Resume training.",
     )
 
+    parser.add_argument(
+        "--async_checkpointing",
+        action="store_true",
+        help=(
+            "Whether to snapshot checkpoints to CPU memory and write them to disk in a background thread instead of"
+            " blocking training. Checkpoints are written to `output_dir/checkpoint-<step>` and `latest_checkpoint.pt`"
+            " is only updated once they are complete."
+        ),
+    )
+
     parser.add_argument(
         "--logging_steps",
         type=int,
         default=500,
         help="Number of steps between each logging",
     )
+    parser.add_argument(
+        "--log_step_timing",
+        action="store_true",
+        help=(
+            "Whether to measure the time spent in every phase of the training step (data wait, host to device copy,"
+            " masking on the device, forward, backward, gradient scaling and norm, optimizer step) and the training throughput, logged every"
+            " `logging_steps` steps."
+        ),
+    )
     parser.add_argument(
         "--saving_steps",
         type=int,
@@ -90,6 +148,35 @@ def parse_args():
         default="duration",
         help="Column in the dataset that contains speech file path. Defaults to 'audio'",
     )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "Whether to stream the training manifests in chunks instead of loading them up front. Rows are split"
+            " across processes and DataLoader workers and shuffled in a bounded buffer. Requires `max_train_steps`."
+        ),
+    )
+    parser.add_argument(
+        "--shuffle_buffer_size",
+        type=int,
+        default=10000,
+        help="Number of manifest rows each DataLoader worker shuffles at a time with `--streaming`.",
+    )
+    parser.add_argument(
+        "--streaming_chunk_size",
+        type=int,
+        default=10000,
+        help="Number of manifest rows read at a time with `--streaming`.",
+    )
+    parser.add_argument(
+        "--shard_dir",
+        type=str,
+        default=None,
+        help=(
+            "Directory written by `shard_store.py`. If set, waveforms are served as memory-mapped slices of the"
+            " pre-decoded shards instead of reading the individual audio files."
+        ),
+    )
 
     parser.add_argument(
         "--model_name_or_path",
@@ -111,6 +198,44 @@ def parse_args():
         help="Batch size (per device) for the training dataloader.",
     )
 
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help=(
+            "Whether to batch training examples of similar duration together (requires the duration column) to"
+            " reduce padding."
+        ),
+    )
+    parser.add_argument(
+        "--max_batch_duration_in_seconds",
+        type=float,
+        default=None,
+        help=(
+            "If set, training batches are filled up to this many seconds of audio per device (requires the duration"
+            " column) instead of holding `per_device_train_batch_size` examples."
+        ),
+    )
+    parser.add_argument(
+        "--batch_duration_budget",
+        type=str,
+        default="padded",
+        choices=["padded", "audio"],
+        help=(
+            "Whether `max_batch_duration_in_seconds` bounds the padded batch (longest clip times number of clips) or"
+            " the summed duration of the clips."
+        ),
+    )
+    parser.add_argument(
+        "--length_bucket_size",
+        type=int,
+        default=100,
+        help=(
+            "Number of batches whose examples are sorted by duration together when `--group_by_length` is set. Larger"
+            " values reduce padding further but make batches less random. Also used by"
+            " `--max_batch_duration_in_seconds`."
+        ),
+    )
+
     parser.add_argument(
         "--per_device_eval_batch_size",
         type=int,
@@ -137,6 +262,53 @@ def parse_args():
         default=1,
         help="Number of updates steps to accumulate before performing a backward/update pass.",
     )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=None,
+        help=(
+            "Number of DataLoader worker processes. Defaults to 16, or to a quarter of the cores of the process with"
+            " `--cpu_profile` on CPU."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=16,
+        help="Number of batches loaded in advance by each DataLoader worker.",
+    )
+    parser.add_argument(
+        "--cpu_profile",
+        action="store_true",
+        help=(
+            "Whether to tune training on CPU-only machines: the cores are split between the DataLoader workers (one"
+            " thread each) and the intra-op threads of the training process. Ignored on GPUs."
+        ),
+    )
+    parser.add_argument(
+        "--num_compute_threads",
+        type=int,
+        default=None,
+        help="Number of intra-op threads with `--cpu_profile`. Defaults to the cores not used by DataLoader workers.",
+    )
+    parser.add_argument(
+        "--cpu_bf16",
+        action="store_true",
+        help="Whether to run the forward pass under bfloat16 autocast when training on CPU.",
+    )
+    parser.add_argument(
+        "--torch_compile",
+        action="store_true",
+        help="Whether to compile the forward pass of the model with `torch.compile` (PyTorch >= 2.0).",
+    )
+    parser.add_argument(
+        "--shard_optimizer_state",
+        action="store_true",
+        help=(
+            "Whether to partition the AdamW state across processes (ZeRO stage 1) instead of replicating it. Checkpoints"
+            " keep the full optimizer state and can be resumed with a different number of processes."
+        ),
+    )
     parser.add_argument(
         "--gradient_checkpointing",
         action="store_true",
@@ -181,6 +353,21 @@ def parse_args():
         default=3.0,
         help="Filter out audio files that are shorter than `min_duration_in_seconds` seconds",
     )
+    parser.add_argument(
+        "--pack_sequences",
+        action="store_true",
+        help=(
+            "Whether to concatenate training utterances (requires the duration column) into windows of at most"
+            " `max_duration_in_seconds`, so batches contain little padding. Only useful if several utterances fit"
+            " into a window, i.e. `2 * min_duration_in_seconds + packing_gap_in_seconds <= max_duration_in_seconds`."
+        ),
+    )
+    parser.add_argument(
+        "--packing_gap_in_seconds",
+        type=float,
+        default=0.1,
+        help="Silence inserted between two utterances packed into the same window.",
+    )
     parser.add_argument(
         "--pad_to_multiple_of",
         type=int,
@@ -190,6 +377,37 @@ def parse_args():
             " use of Tensor Cores on NVIDIA hardware with compute capability >= 7.5 (Volta)."
         ),
     )
+    parser.add_argument(
+        "--mask_on_device",
+        action="store_true",
+        help=(
+            "Whether to sample the masked spans and negatives on the training device after the batch is transferred,"
+            " instead of in the DataLoader workers."
+        ),
+    )
+    parser.add_argument(
+        "--cache_validation",
+        action="store_true",
+        help=(
+            "Whether to decode, pad and mask the validation set once at the start of training and evaluate on the"
+            " cached batches, so that the validation loss is comparable across evaluations."
+        ),
+    )
+    parser.add_argument(
+        "--num_validation_examples",
+        type=int,
+        default=None,
+        help=(
+            "Number of validation examples to cache, drawn once with the training seed. Rounded down to a multiple of"
+            " the global evaluation batch size, so all cached batches have the same shape. Defaults to the whole set."
+        ),
+    )
+    parser.add_argument(
+        "--validation_steps",
+        type=int,
+        default=None,
+        help="Number of steps between evaluations on the cached validation batches, in addition to every epoch.",
+    )
     parser.add_argument(
         "--adam_beta1",
         type=float,
@@ -216,23 +434,125 @@ def parse_args():
     parser.add_argument("--hub_token", type=str, help="The token to use to push to the Model Hub.")
     args = parser.parse_args()
 
+    if args.validation_steps is not None:
+        assert args.cache_validation, "`--validation_steps` evaluates on the cached validation batches, pass `--cache_validation`."
+
     if args.push_to_hub:
         assert args.output_dir is not None, "Need an `output_dir` to create a repo when `--push_to_hub` is passed."
 
+    args.interleave_datasets = args.train_dataset_weights is not None or args.source_temperature is not None
+    if args.interleave_datasets:
+        assert not args.group_by_length and args.max_batch_duration_in_seconds is None, (
+            "Length-aware batching is not supported together with dataset interleaving."
+        )
+
+    if args.streaming:
+        assert args.max_train_steps is not None, "Need `--max_train_steps` with `--streaming`, the dataset size is unknown."
+        assert args.shard_dir is None, "`--shard_dir` is not supported with `--streaming`."
+        assert not args.group_by_length and args.max_batch_duration_in_seconds is None, (
+            "Length-aware batching is not supported with `--streaming`."
+        )
+        if args.interleave_datasets:
+            assert args.train_dataset_weights is not None and args.mixing_epoch_size is not None, (
+                "Interleaving streamed datasets needs `--train_dataset_weights` and `--mixing_epoch_size`, the dataset"
+                " sizes are unknown."
+            )
+            assert len(args.train_dataset_weights) == len(args.train_datasets), (
+                "Need one weight in `--train_dataset_weights` per dataset in `--train_datasets`."
+            )
+
+    if args.pack_sequences:
+        assert not args.streaming and not args.interleave_datasets, (
+            "`--pack_sequences` is not supported with `--streaming` or dataset interleaving."
+        )
+        assert not args.group_by_length and args.max_batch_duration_in_seconds is None, (
+            "Packed windows are filled up to the same length, length-aware batching is not needed with `--pack_sequences`."
+        )
+        if 2 * args.min_duration_in_seconds + args.packing_gap_in_seconds > args.max_duration_in_seconds:
+            warnings.warn(
+                "`--pack_sequences` cannot put two utterances into one window, as 2 * min_duration_in_seconds +"
+                " packing_gap_in_seconds > max_duration_in_seconds; every window holds a single utterance."
+            )
+
     if args.output_dir is not None:
         os.makedirs(args.output_dir, exist_ok=True)
 
     return args
 
+def available_cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+def partition_cpu_threads(num_workers, num_compute_threads=None, processes_per_node=1):
+    """
+    Split the cores available to this process between the DataLoader workers, which run one thread each (see
+    `limit_worker_threads`), and the intra-op threads of training. Returns the number of compute threads.
+    """
+    num_cores = max(1, available_cores() // processes_per_node)
+    if num_compute_threads is None:
+        num_compute_threads = max(1, num_cores - num_workers)
+    torch.set_num_threads(num_compute_threads)
+    try:
+        # the model has no inter-op parallelism to exploit
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work
+        pass
+    return num_compute_threads
+
+
+def limit_worker_threads(worker_id):
+    """`worker_init_fn` that keeps every DataLoader worker on a single thread."""
+    torch.set_num_threads(1)
+
+
+def random_crop(wav, sr, max_duration):
+    if len(wav)//sr > max_duration:
+        start = np.random.randint(0, len(wav) - max_duration * sr)
+        wav = wav[start : start + int(max_duration * sr)]
+    return wav
+
+
+def read_audio(path, sr, max_duration):
+    with sf.SoundFile(path) as f:
+        if f.frames//sr > max_duration and f.seekable():
+            # choose the crop from the header and only read and decode the frames that are used
+            start = np.random.randint(0, f.frames - max_duration * sr)
+            f.seek(start)
+            wav = f.read(int(max_duration * sr))
+        else:
+            wav = random_crop(f.read(), sr, max_duration)
+    #---
+    # wav = np.mean(wav, axis=1) #JAY Changes Stereo to Mono when not preprocessed
+    #---
+    return wav
+
+
 class CustomDataset(Dataset):
-    def __init__(self, files, sep, sr, audio_column_name, duration_column_name, min_duration, max_duration):
+    def __init__(self, files, sep, sr, audio_column_name, duration_column_name, min_duration, max_duration, shard_dir=None,
+                 return_source_ids=False):
+        self.files = [files] if isinstance(files, str) else files
+        self.return_source_ids = return_source_ids
         self.sep = sep
         self.sr = sr
         self.min_duration = min_duration
         self.max_duration = max_duration
         self.audio_column_name = audio_column_name
         self.duration_column_name = duration_column_name
-        self.data = self.load_ds(files)
+        data = self.load_ds(files)
+        self.shards = None
+        if shard_dir is not None:
+            self.shards = ShardStore(shard_dir)
+            if self.shards.sr is not None and self.shards.sr != self.sr:
+                raise ValueError(f"Shards in {shard_dir} have a sampling rate of {self.shards.sr}, expected {self.sr}")
+            self.shard_ids = self.shards.lookup(data[self.audio_column_name])
+            if (self.shard_ids < 0).any():
+                raise ValueError(
+                    f"{(self.shard_ids < 0).sum()} audio files are missing from {shard_dir}, re-run `shard_store.py`"
+                )
+        # keep only the columns used for training in flat arrays, so forked DataLoader workers do not copy them on read
+        columns = [c for c in [self.audio_column_name, self.duration_column_name, "source_id"] if c in data.columns]
+        self.data = CompactManifest(data, columns=columns)
 
     def load_ds(self, all_files):
         li = []
@@ -240,8 +560,9 @@ class CustomDataset(Dataset):
         if isinstance(all_files, str): #JAY
             all_files = [all_files] #JAY
 
-        for filename in all_files:
+        for source_id, filename in enumerate(all_files):
             df = pd.read_csv(filename, sep=self.sep, engine="python")
+            df["source_id"] = source_id
             li.append(df)
         data = pd.concat(li, axis=0, ignore_index=True)
 
@@ -252,22 +573,188 @@ class CustomDataset(Dataset):
             print("Mean duration: ", data[self.duration_column_name].mean())
         return data
 
+    def durations(self):
+        if self.duration_column_name not in self.data.columns:
+            raise ValueError(f"Length-aware batching needs the `{self.duration_column_name}` column in the dataset")
+        durations = self.data.column(self.duration_column_name).astype(np.float64)
+        # clips above `max_duration` are randomly cropped in __getitem__
+        return np.where(durations // 1 > self.max_duration, self.max_duration, durations)
+
     def __len__(self) -> int:
         return len(self.data)
 
     def __getitem__(self, idx):
-        item = self.data.iloc[idx]
         batch = {}
-        batch["input_values"] = sf.read(item[self.audio_column_name])[0]
-        #---
-        # batch["input_values"] = np.mean(batch["input_values"], axis=1) #JAY Changes Stereo to Mono when not preprocessed
-        #---
-        if len(batch["input_values"])//self.sr > self.max_duration:
-            start = np.random.randint(0, len(batch["input_values"]) - self.max_duration * self.sr)
-            batch["input_values"] = batch["input_values"][start : start + int(self.max_duration * self.sr)]
+        if self.shards is not None:
+            # crop the memory-mapped view first so only the used window is copied out of the shard
+            wav = random_crop(self.shards.read(self.shard_ids[idx]), self.sr, self.max_duration)
+            batch["input_values"] = wav.astype(np.float32) / 32768.0
+            if self.return_source_ids:
+                batch["source_id"] = self.data.get("source_id", idx)
+            return batch
+
+        batch["input_values"] = read_audio(self.data.get(self.audio_column_name, idx), self.sr, self.max_duration)
+        if self.return_source_ids:
+            batch["source_id"] = self.data.get("source_id", idx)
 
         return batch
 
+class PackedDataset(Dataset):
+    """
+    Packs the utterances of a `CustomDataset` into windows of at most `max_duration` seconds. Utterances are shuffled
+    and added to the current window, separated by `gap` seconds of silence, until the next one does not fit anymore.
+    A window ends with its last utterance, the unfilled rest is padding added by the collator and excluded by the
+    attention mask, so no masks, losses or negatives fall on artificial silence. The packing is redone with a new
+    order by `set_epoch`. The window layout is kept in two flat arrays, an offsets array into the utterance ids of
+    all windows.
+    """
+    def __init__(self, dataset, gap=0.1, seed=0):
+        self.dataset = dataset
+        self.window = int(dataset.max_duration * dataset.sr)
+        self.gap = int(gap * dataset.sr)
+        self.seed = seed
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch):
+        lengths = (self.dataset.durations() * self.dataset.sr).astype(np.int64)
+        rng = np.random.default_rng([self.seed, epoch])
+        order = rng.permutation(len(lengths))
+        offsets, fill = [0], 0
+        for position, idx in enumerate(order):
+            needed = lengths[idx] if fill == 0 else fill + self.gap + lengths[idx]
+            if fill > 0 and needed > self.window:
+                offsets.append(position)
+                needed = lengths[idx]
+            fill = needed
+        offsets.append(len(order))
+        self.members = order
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.fill_ratio = lengths.sum() / (len(self) * self.window) if len(self) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        window = np.zeros(self.window, dtype=np.float32)
+        position, end = 0, 0
+        for member in self.members[self.offsets[idx] : self.offsets[idx + 1]]:
+            wav = self.dataset[member]["input_values"][: self.window - position]
+            window[position : position + len(wav)] = wav
+            end = position + len(wav)
+            position = min(end + self.gap, self.window)
+        return {"input_values": window[:end]}
+
+class StreamingCustomDataset(IterableDataset):
+    """
+    Streams the rows of the manifests chunk by chunk, so start-up time and memory do not depend on the manifest size.
+    Rows are dealt round-robin to the `num_shards * num_workers` DataLoader workers of all processes, and only complete
+    rounds are used, so every process yields exactly the same number of examples. Each worker shuffles its rows in a
+    buffer of `shuffle_buffer_size` paths before decoding them. `set_epoch` can skip the first batches of an epoch
+    (of `batch_size` examples, dealt round-robin from the workers by the DataLoader) without decoding them.
+    With `probabilities`, the manifests are interleaved instead of concatenated: every example is drawn from a manifest
+    sampled by these probabilities, and a manifest is only read once it is drawn for the first time and read again
+    (with a new shuffle) once exhausted. An epoch then has `epoch_size` examples.
+    """
+    def __init__(self, files, sep, sr, audio_column_name, duration_column_name, min_duration, max_duration,
+                 num_shards=1, shard_id=0, shuffle_buffer_size=10000, chunk_size=10000, seed=0, batch_size=1,
+                 probabilities=None, epoch_size=None, return_source_ids=False):
+        self.files = [files] if isinstance(files, str) else files
+        self.probabilities = None if probabilities is None else np.asarray(probabilities, dtype=np.float64)
+        self.epoch_size = epoch_size
+        self.return_source_ids = return_source_ids
+        self.sep = sep
+        self.sr = sr
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+        self.audio_column_name = audio_column_name
+        self.duration_column_name = duration_column_name
+        self.num_shards = num_shards
+        self.shard_id = shard_id
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.batch_size = batch_size
+        self.epoch = 0
+        self.skip_batches = 0
+
+    def set_epoch(self, epoch, skip_batches=0):
+        self.epoch = epoch
+        self.skip_batches = skip_batches
+
+    def manifest_rows(self, files=None):
+        engine = "c" if self.sep is not None and len(self.sep) == 1 else "python"
+        for filename in self.files if files is None else files:
+            for chunk in pd.read_csv(filename, sep=self.sep, engine=engine, chunksize=self.chunk_size):
+                if self.duration_column_name in chunk.columns:
+                    chunk = chunk[chunk[self.duration_column_name] >= self.min_duration]
+                yield from chunk[self.audio_column_name].tolist()
+
+    def shard_rows(self, num_streams, stream_id, files=None):
+        pending = None
+        for row, path in enumerate(self.manifest_rows(files)):
+            if row % num_streams == stream_id:
+                pending = path
+            # only hand out the row once its round is complete, an incomplete last round is dropped
+            if row % num_streams == num_streams - 1 and pending is not None:
+                yield pending
+                pending = None
+
+    def shuffle(self, paths, rng):
+        if self.shuffle_buffer_size <= 1:
+            yield from paths
+            return
+        buffer = []
+        for path in paths:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(path)
+                continue
+            i = rng.integers(len(buffer))
+            yield buffer[i]
+            buffer[i] = path
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def source_rows(self, source_id, num_streams, stream_id):
+        """Shuffled rows of one manifest for this stream, read again with a new shuffle once exhausted."""
+        for repeat in itertools.count():
+            rng = np.random.default_rng([self.seed, self.epoch, stream_id, source_id, repeat])
+            empty = True
+            for path in self.shuffle(self.shard_rows(num_streams, stream_id, [self.files[source_id]]), rng):
+                empty = False
+                yield path
+            if empty:
+                raise ValueError(f"{self.files[source_id]} has fewer rows than the {num_streams} DataLoader workers")
+
+    def mixed_rows(self, num_streams, stream_id, rng):
+        # the rows of a manifest are only read once it is drawn
+        sources = {}
+        for _ in range(self.epoch_size // num_streams):
+            source_id = int(rng.choice(len(self.files), p=self.probabilities))
+            if source_id not in sources:
+                sources[source_id] = self.source_rows(source_id, num_streams, stream_id)
+            yield source_id, next(sources[source_id])
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers, worker_id = (1, 0) if worker_info is None else (worker_info.num_workers, worker_info.id)
+        # The DataLoader restarts its round-robin at worker 0, while the next batch of the epoch comes from worker
+        # `skip_batches % num_workers`: rotate the workers, so the resumed epoch continues with the exact next batch
+        worker_id = (worker_id + self.skip_batches) % num_workers
+        num_streams = self.num_shards * num_workers
+        stream_id = self.shard_id * num_workers + worker_id
+        rng = np.random.default_rng([self.seed, self.epoch, stream_id])
+        # this worker's share of the skipped batches
+        num_skipped = self.skip_batches // num_workers + int(worker_id < self.skip_batches % num_workers)
+        if self.probabilities is None:
+            rows = ((0, path) for path in self.shuffle(self.shard_rows(num_streams, stream_id), rng))
+        else:
+            rows = self.mixed_rows(num_streams, stream_id, rng)
+        for source_id, path in itertools.islice(rows, num_skipped * self.batch_size, None):
+            example = {"input_values": read_audio(path, self.sr, self.max_duration)}
+            if self.return_source_ids:
+                example["source_id"] = source_id
+            yield example
+
 @dataclass
 class DataCollatorForWav2Vec2Pretraining:
     """
@@ -295,25 +782,41 @@ class DataCollatorForWav2Vec2Pretraining:
             If set will pad the sequence to a multiple of the provided value.
             This is especially useful to enable the use of Tensor Cores on NVIDIA hardware with compute capability >=
             7.5 (Volta).
+        mask_on_device (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            If set, the collator only pads the inputs and :meth:`add_masks` has to be called on the batch later, e.g.
+            on the training device after the transfer.
+        generator (:obj:`torch.Generator`, `optional`):
+            Generator used to sample the masked indices and negatives. Defaults to the global torch RNG.
+        return_attention_mask (:obj:`bool`, `optional`):
+            Whether to return the attention mask of the padded inputs. Defaults to the setting of the feature extractor.
     """
 
     model: Wav2Vec2ForPreTraining
     feature_extractor: Wav2Vec2FeatureExtractor
     padding: Union[bool, str] = "longest"
+    max_length: Optional[int] = None
     pad_to_multiple_of: Optional[int] = None
+    mask_on_device: bool = False
+    generator: Optional[torch.Generator] = None
+    return_attention_mask: Optional[bool] = None
 
     def __call__(self, features: List[Dict[str, Union[List[int], torch.Tensor]]]) -> Dict[str, torch.Tensor]:
+        # keep track of the dataset every example was drawn from when interleaving datasets
+        source_ids = None
+        if "source_id" in features[0]:
+            source_ids = torch.tensor([feature["source_id"] for feature in features], dtype=torch.long)
+            features = [{k: v for k, v in feature.items() if k != "source_id"} for feature in features]
+
         # reformat list to dict and set to pytorch format
         batch = self.feature_extractor.pad(
             features,
             padding=self.padding,
+            max_length=self.max_length,
             pad_to_multiple_of=self.pad_to_multiple_of,
+            return_attention_mask=self.return_attention_mask,
             return_tensors="pt",
         )
 
-        device = batch["input_values"].device
-        batch_size = batch["input_values"].shape[0]
-
         mask_indices_seq_length = self.model._get_feat_extract_output_lengths(batch["input_values"].shape[-1])
 
         # make sure masked sequence length is a Python scalar
@@ -325,46 +828,85 @@ class DataCollatorForWav2Vec2Pretraining:
             batch["sub_attention_mask"] = self.model._get_feature_vector_attention_mask(
                 mask_indices_seq_length, batch["attention_mask"]
             )
+        if source_ids is not None:
+            batch["source_ids"] = source_ids
+
+        if not self.mask_on_device:
+            batch = self.add_masks(batch)
+        return batch
 
+    def add_masks(self, batch, generator: Optional[torch.Generator] = None):
+        """Sample the masked indices and negatives of a padded batch, on the device the batch is on."""
+        generator = generator if generator is not None else self.generator
+        device = batch["input_values"].device
+        batch_size = batch["input_values"].shape[0]
+        mask_indices_seq_length = int(self.model._get_feat_extract_output_lengths(batch["input_values"].shape[-1]))
         features_shape = (batch_size, mask_indices_seq_length)
 
         # sample randomly masked indices
-        mask_time_indices = _compute_mask_indices(
+        mask_time_indices = compute_mask_indices(
             features_shape,
             self.model.config.mask_time_prob,
             self.model.config.mask_time_length,
-            attention_mask=batch.get("sub_attention_mask")
+            attention_mask=batch.get("sub_attention_mask"),
+            generator=generator,
+            device=device,
         )
 
         # sample negative indices
-        sampled_negative_indices = _sample_negative_indices(
+        sampled_negative_indices = sample_negative_indices(
             features_shape,
             self.model.config.num_negatives,
             mask_time_indices=mask_time_indices,
+            generator=generator,
         )
-        batch["mask_time_indices"] = torch.tensor(mask_time_indices, dtype=torch.long, device=device)
-        batch["sampled_negative_indices"] = torch.tensor(sampled_negative_indices, dtype=torch.long, device=device)
+        batch["mask_time_indices"] = mask_time_indices.long()
+        batch["sampled_negative_indices"] = sampled_negative_indices
 
         return batch
 
+def cache_validation_batches(dataset, data_collator, indices, batch_size, generator, num_workers=0):
+    """
+    Decode, pad and mask the validation examples `indices` once. All batches are padded to the longest example and
+    their masked indices and negatives are drawn from `generator`, so repeated evaluations see identical inputs.
+    """
+    loader = DataLoader(Subset(dataset, indices), batch_size=batch_size, collate_fn=list, num_workers=num_workers)
+    chunks = list(loader)
+    if not chunks:
+        return []
+    max_length = max(len(feature["input_values"]) for chunk in chunks for feature in chunk)
+    collator = replace(data_collator, padding="max_length", max_length=max_length, mask_on_device=False,
+                       generator=generator)
+    return [collator(chunk) for chunk in chunks]
+
+
 def multiply_grads(params, c):
-    """Multiplies grads by a constant *c*."""
-    for p in params:
-        if p.grad is not None:
-            if torch.is_tensor(c):
-                c = c.to(p.grad.device)
-            p.grad.data.mul_(c)
+    """Multiplies grads by a constant *c* with a single fused kernel launch per device."""
+    grads = [p.grad for p in params if p.grad is not None]
+    if not grads:
+        return
+    if torch.is_tensor(c):
+        c = c.to(device=grads[0].device, dtype=torch.float32)
+    try:
+        torch._foreach_mul_(grads, c)
+    except (TypeError, RuntimeError):
+        # torch versions without the tensor-scalar `_foreach_mul_` overload
+        for grad in grads:
+            grad.mul_(c)
 
 
 def get_grad_norm(params, scale=1):
-    """Compute grad norm given a gradient scale."""
-    total_norm = 0.0
-    for p in params:
-        if p.grad is not None:
-            param_norm = (p.grad.detach().data / scale).norm(2)
-            total_norm += param_norm.item() ** 2
-    total_norm = total_norm**0.5
-    return total_norm
+    """
+    Compute grad norm given a gradient scale. The norm is returned as a tensor on the gradients' device, so the
+    host only synchronizes once, when the value is read.
+    """
+    grads = [p.grad.detach() for p in params if p.grad is not None]
+    if not grads:
+        return torch.tensor(0.0)
+    device = grads[0].device
+    norms = torch._foreach_norm(grads)
+    total_norm = torch.linalg.vector_norm(torch.stack([norm.to(device=device, dtype=torch.float32) for norm in norms]))
+    return total_norm / scale
 
 def main():
     # See all possible arguments in src/transformers/args.py
@@ -385,6 +927,27 @@ def main():
     if args.seed is not None:
         set_seed(args.seed)
 
+    # CPU execution profile
+    cpu_profile = args.cpu_profile and accelerator.device.type == "cpu"
+    processes_per_node = int(os.environ.get("LOCAL_WORLD_SIZE", 1))
+    if args.dataloader_num_workers is None:
+        args.dataloader_num_workers = max(1, available_cores() // processes_per_node // 4) if cpu_profile else 16
+    if cpu_profile:
+        num_compute_threads = partition_cpu_threads(
+            args.dataloader_num_workers, args.num_compute_threads, processes_per_node=processes_per_node
+        )
+        if accelerator.is_main_process:
+            print("CPU profile: {} DataLoader workers and {} compute threads per process".format(
+                args.dataloader_num_workers, num_compute_threads))
+    cpu_autocast = args.cpu_bf16 and accelerator.device.type == "cpu"
+    loader_kwargs = {
+        "num_workers": args.dataloader_num_workers,
+        "pin_memory": accelerator.device.type == "cuda",
+        "worker_init_fn": limit_worker_threads if cpu_profile else None,
+    }
+    if args.dataloader_num_workers > 0:
+        loader_kwargs["prefetch_factor"] = args.dataloader_prefetch_factor
+
     # Handle the repository creation
     if accelerator.is_main_process:
         if args.push_to_hub:
@@ -400,14 +963,41 @@ def main():
     accelerator.wait_for_everyone()
 
     # Download data
-    train_dataset = CustomDataset(
-        args.train_datasets,
-        sep=args.separator,
-        audio_column_name=args.audio_column_name,
-        duration_column_name=args.duration_column_name,
-        sr=16000,
-        min_duration=args.min_duration_in_seconds,
-        max_duration=args.max_duration_in_seconds)
+    if args.streaming:
+        train_dataset = StreamingCustomDataset(
+            args.train_datasets,
+            sep=args.separator,
+            audio_column_name=args.audio_column_name,
+            duration_column_name=args.duration_column_name,
+            sr=16000,
+            min_duration=args.min_duration_in_seconds,
+            max_duration=args.max_duration_in_seconds,
+            num_shards=accelerator.num_processes,
+            shard_id=accelerator.process_index,
+            shuffle_buffer_size=args.shuffle_buffer_size,
+            chunk_size=args.streaming_chunk_size,
+            seed=args.seed or 0,
+            batch_size=args.per_device_train_batch_size,
+            probabilities=(source_probabilities(args.train_dataset_weights, args.source_temperature or 1.0)
+                           if args.interleave_datasets else None),
+            epoch_size=args.mixing_epoch_size,
+            return_source_ids=args.interleave_datasets)
+        if args.interleave_datasets and accelerator.is_main_process:
+            for filename, probability in zip(train_dataset.files, train_dataset.probabilities):
+                print(f"Sampling probability of {filename}: {probability:.4f}")
+    else:
+        train_dataset = CustomDataset(
+            args.train_datasets,
+            sep=args.separator,
+            audio_column_name=args.audio_column_name,
+            duration_column_name=args.duration_column_name,
+            sr=16000,
+            min_duration=args.min_duration_in_seconds,
+            max_duration=args.max_duration_in_seconds,
+            shard_dir=args.shard_dir,
+            return_source_ids=args.interleave_datasets)
+        if args.pack_sequences:
+            train_dataset = PackedDataset(train_dataset, gap=args.packing_gap_in_seconds, seed=args.seed or 0)
 
     val_dataset = CustomDataset(
         args.val_datasets,
@@ -416,7 +1006,8 @@ def main():
         duration_column_name=args.duration_column_name,
         sr=16000,
         min_duration=args.min_duration_in_seconds,
-        max_duration=args.max_duration_in_seconds)
+        max_duration=args.max_duration_in_seconds,
+        shard_dir=args.shard_dir)
 
 
     # Load feature_extractor
@@ -450,31 +1041,86 @@ def main():
     if args.gradient_checkpointing:
         model.gradient_checkpointing_enable()
 
+    # compile only the forward pass, so the module and its state dict keys stay unchanged for checkpointing
+    if args.torch_compile:
+        model.forward = torch.compile(model.forward)
+
     # Define data collator, optimizer and scheduler
     data_collator = DataCollatorForWav2Vec2Pretraining(
-        model=model, feature_extractor=feature_extractor, pad_to_multiple_of=args.pad_to_multiple_of
+        model=model,
+        feature_extractor=feature_extractor,
+        pad_to_multiple_of=args.pad_to_multiple_of,
+        mask_on_device=args.mask_on_device,
     )
 
-    train_dataloader = DataLoader(
-        train_dataset,
-        collate_fn=data_collator,
-        batch_size=args.per_device_train_batch_size,
-        shuffle=True,
-        num_workers=16,
-        pin_memory=True,
-        prefetch_factor=16
-    )
+    train_batch_sampler = None
+    if args.interleave_datasets and not args.streaming:
+        train_batch_sampler = WeightedSourceBatchSampler(
+            train_dataset.data.column("source_id"),
+            batch_size=args.per_device_train_batch_size,
+            num_sources=len(train_dataset.files),
+            weights=args.train_dataset_weights,
+            temperature=args.source_temperature or 1.0,
+            epoch_size=args.mixing_epoch_size,
+            num_replicas=accelerator.num_processes,
+            rank=accelerator.process_index,
+            seed=args.seed or 0,
+        )
+        if accelerator.is_main_process:
+            for filename, probability in zip(train_dataset.files, train_batch_sampler.probabilities):
+                print(f"Sampling probability of {filename}: {probability:.4f}")
+    elif args.max_batch_duration_in_seconds is not None:
+        train_batch_sampler = DurationBudgetBatchSampler(
+            train_dataset.durations(),
+            max_batch_duration=args.max_batch_duration_in_seconds,
+            budget=args.batch_duration_budget,
+            bucket_size=args.length_bucket_size,
+            num_replicas=accelerator.num_processes,
+            rank=accelerator.process_index,
+            seed=args.seed or 0,
+        )
+    elif args.group_by_length:
+        train_batch_sampler = BucketBatchSampler(
+            train_dataset.durations(),
+            batch_size=args.per_device_train_batch_size,
+            bucket_size=args.length_bucket_size,
+            num_replicas=accelerator.num_processes,
+            rank=accelerator.process_index,
+            seed=args.seed or 0,
+        )
+
+    if train_batch_sampler is not None:
+        train_dataloader = DataLoader(
+            train_dataset,
+            collate_fn=data_collator,
+            batch_sampler=train_batch_sampler,
+            **loader_kwargs
+        )
+    else:
+        train_dataloader = DataLoader(
+            train_dataset,
+            # packed windows of different fill are padded, the attention mask keeps the padding out of the loss
+            collate_fn=replace(data_collator, return_attention_mask=True) if args.pack_sequences else data_collator,
+            batch_size=args.per_device_train_batch_size,
+            shuffle=not args.streaming,
+            **loader_kwargs
+        )
 
     eval_dataloader = DataLoader(
         val_dataset,
         collate_fn=data_collator,
         batch_size=args.per_device_eval_batch_size,
-        num_workers=16
+        num_workers=args.dataloader_num_workers,
+        worker_init_fn=loader_kwargs["worker_init_fn"],
     )
 
     # Optimizer
-    optimizer =  torch.optim.AdamW(
+    if args.shard_optimizer_state:
+        # the partitions are assigned to the parameters on their training device
+        model.to(accelerator.device)
+    optimizer = create_optimizer(
         list(model.parameters()),
+        shard_state=args.shard_optimizer_state,
         lr=args.learning_rate,
         betas=[args.adam_beta1, args.adam_beta2],
         eps=args.adam_epsilon,
@@ -488,48 +1134,267 @@ def main():
     )
 
     # Prepare everything with our `accelerator`.
-    model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
-        model, optimizer, train_dataloader, eval_dataloader
-    )
+    # the batch samplers and the streaming dataset already shard the training batches across processes
+    shard_train_batches = train_batch_sampler is not None or args.streaming
+    if shard_train_batches:
+        model, optimizer, eval_dataloader = accelerator.prepare(model, optimizer, eval_dataloader)
+    else:
+        # the training batches are moved to the device in the training loop, so the copy is timed as its own phase
+        model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
+            model, optimizer, train_dataloader, eval_dataloader, device_placement=[None, None, False, None]
+        )
     if args.resume:
         print("******Resume checkpoint******")
-        accelerator.load_state(args.output_dir)
         checkpoint = torch.load(os.path.join(args.output_dir, 'latest_checkpoint.pt'),
                                 map_location="cpu")
+        # checkpoints written by the asynchronous writer live in their own directory
+        if "state_dir" in checkpoint:
+            load_checkpoint(accelerator, os.path.join(args.output_dir, checkpoint["state_dir"]),
+                            model, optimizer, lr_scheduler)
+        else:
+            accelerator.load_state(args.output_dir)
+
+    def report_optimizer_memory():
+        line = "Rank {}: optimizer state {:.1f} MB".format(accelerator.process_index, optimizer_state_mb(optimizer))
+        if accelerator.device.type == "cuda":
+            line += ", peak allocated {:.1f} MB".format(torch.cuda.max_memory_allocated(accelerator.device) / 2**20)
+        print(line)
+
+    # optimizer state of every process with and without sharding, then the realized one after the first update
+    optimizer_memory_reported = not args.shard_optimizer_state
+    if args.shard_optimizer_state:
+        print("Rank {}: AdamW state {:.1f} MB when replicated, {:.1f} MB with sharding".format(
+            accelerator.process_index, expected_state_mb(optimizer, replicated=True), expected_state_mb(optimizer)))
+
+    checkpoint_writer = None
+    if args.async_checkpointing and args.output_dir is not None:
+        checkpoint_writer = AsyncCheckpointWriter(accelerator, args.output_dir)
+
+    # decode, pad and mask a fixed validation subset once, every process keeps its share on the host
+    validation_batches = None
+    if args.cache_validation:
+        num_validation = len(val_dataset) if args.num_validation_examples is None else args.num_validation_examples
+        num_validation = min(num_validation, len(val_dataset))
+        global_eval_batch_size = args.per_device_eval_batch_size * accelerator.num_processes
+        if num_validation >= global_eval_batch_size:
+            num_validation -= num_validation % global_eval_batch_size
+        validation_indices = np.sort(np.random.default_rng(args.seed or 0).permutation(len(val_dataset))[:num_validation])
+        validation_batches = cache_validation_batches(
+            val_dataset,
+            data_collator,
+            validation_indices[accelerator.process_index :: accelerator.num_processes].tolist(),
+            batch_size=args.per_device_eval_batch_size,
+            generator=torch.Generator().manual_seed((args.seed or 0) + accelerator.process_index),
+            num_workers=args.dataloader_num_workers,
+        )
+        if accelerator.is_main_process:
+            print("Cached {} validation examples in {} batches per process".format(
+                num_validation, len(validation_batches)))
+
+    # realized number of examples drawn from every training dataset
+    source_counts = None
+    if args.interleave_datasets:
+        source_counts = np.zeros(len(train_dataset.files), dtype=np.int64)
+
+    mask_generator = None
+    if args.mask_on_device:
+        mask_generator = torch.Generator(device=accelerator.device)
+        mask_generator.manual_seed((args.seed or 0) + accelerator.process_index)
+
+    def evaluate():
+        """Summed validation losses over all processes, divided by the number of masked frames."""
+        model.eval()
+        # init logs
+        val_logs = {
+            "val_loss": 0,
+            "val_contrastive_loss": 0,
+            "val_diversity_loss": 0,
+            "val_num_losses": 0,
+        }
+        for step, batch in enumerate(validation_batches if validation_batches is not None else eval_dataloader):
+            if validation_batches is not None:
+                batch = send_to_device(dict(batch), accelerator.device)
+            elif args.mask_on_device:
+                batch = data_collator.add_masks(batch, generator=mask_generator)
+            with torch.no_grad(), torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=cpu_autocast):
+                batch.pop("sub_attention_mask", None)
+                outputs = model(**batch)
+
+            val_logs["val_loss"] += outputs.loss
+            val_logs["val_contrastive_loss"] += outputs.contrastive_loss
+            val_logs["val_diversity_loss"] += outputs.diversity_loss
+            val_logs["val_num_losses"] += batch["mask_time_indices"].sum()
+
+        # sum over devices in multi-processing
+        if accelerator.num_processes > 1:
+            val_logs = {k: accelerator.gather(v).sum() for k, v in val_logs.items()}
+
+        return {k: v / val_logs["val_num_losses"] for k, v in val_logs.items()}
 
     # Train
     total_batch_size = args.per_device_train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
 
     # Scheduler and math around the number of training steps.
-    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+    # With streaming the epoch length is unknown, training stops after `max_train_steps` or `num_train_epochs` passes
+    if not args.streaming:
+        num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
 
 
-    if args.max_train_steps is None:
-        args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
+        if args.max_train_steps is None:
+            args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
 
 
-    # Afterwards we recalculate our number of training epochs
-    args.num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
+        # Afterwards we recalculate our number of training epochs
+        args.num_train_epochs = math.ceil(args.max_train_steps / num_update_steps_per_epoch)
 
-    if accelerator.is_main_process:
-        print("\nNumber of training data: ", len(train_dataset))
+    if accelerator.is_main_process and args.streaming:
+        print("\nStreaming training data from: ", args.train_datasets)
         print("total_batch_size: ", total_batch_size)
+        print("max_train_steps: ", args.max_train_steps, "\n")
+    elif accelerator.is_main_process:
+        print("\nNumber of training data: ", len(train_dataset))
+        if args.max_batch_duration_in_seconds is not None:
+            print("total_batch_size: dynamic, up to {}s of {} audio per device".format(
+                args.max_batch_duration_in_seconds, args.batch_duration_budget))
+        else:
+            print("total_batch_size: ", total_batch_size)
         print("num_update_steps_per_epoch: ", num_update_steps_per_epoch)
         print("num_train_epochs: ", args.num_train_epochs, "\n")
 
     # Only show the progress bar once on each machine.
     completed_steps = checkpoint['completed_steps'] + 1 if args.resume else 0
     starting_epoch = checkpoint['epoch'] if args.resume else 0
+    # checkpoints with a resume state continue at the next batch of the interrupted epoch
+    resume_state = checkpoint.get("resume") if args.resume else None
+    if resume_state is not None:
+        completed_steps = checkpoint['completed_steps']
+        starting_epoch = resume_state["epoch"]
+        if completed_steps > 0:
+            gumbel_temperature = max(
+                args.max_gumbel_temperature * args.gumbel_temperature_decay**(completed_steps - 1),
+                args.min_gumbel_temperature,
+            )
+            accelerator.unwrap_model(model).set_gumbel_temperature(gumbel_temperature)
     progress_bar = tqdm(initial = completed_steps, total = args.max_train_steps, disable=not accelerator.is_local_main_process)
 
     print(f"******STARTING AT EPOCH {starting_epoch} - STEP {completed_steps}******")
 
+    step_timer = StepTimer(accelerator.device, enabled=args.log_step_timing)
+    # training metrics are summed on the device and written once their copy to the host has finished
+    metrics = MetricAccumulator(accelerator)
+
+    def write_train_logs(logged_step, values):
+        train_logs = {
+            "step": values["step"],
+            "loss": values["loss"] * args.gradient_accumulation_steps / values["num_losses"],
+            "contrast_loss": values["contrast_loss"] / values["num_losses"],
+            "div_loss": values["div_loss"] / values["num_losses"],
+            "%_mask_idx": values["%_mask_idx"] / accelerator.num_processes,
+            "ppl": values["ppl"],
+            "lr": values["lr"],
+            "temp": values["temp"],
+            "grad_norm": values["grad_norm"],
+            "cosine_sim": values["cosine_sim"] / accelerator.num_processes * 100
+        }
+        log_str = ""
+        for k, v in train_logs.items():
+            log_str += "| {}: {:.3e}".format(k, v)
+
+        if source_counts is not None:
+            source_counts[:] += np.asarray(values["source_counts"], dtype=np.int64)
+
+        if accelerator.is_local_main_process:
+            progress_bar.write(log_str)
+            for k, v in train_logs.items():
+                writer.add_scalar('TRAIN' + '/' + k, v, logged_step)
+            if source_counts is not None:
+                for filename, count in zip(train_dataset.files, source_counts):
+                    writer.add_scalar('SOURCES/' + Path(filename).stem, count, logged_step)
+
+        if "timings" in values and accelerator.is_local_main_process:
+            timings = values["timings"]
+            num_examples, num_audio_samples = values["throughput"]
+            phases = ["data_wait", "h2d", "masks", "forward", "backward", "grads", "optimizer"]
+            timing_str = "| samples/s: {:.1f} | audio s/s: {:.1f}".format(
+                num_examples / timings["wall"],
+                num_audio_samples / feature_extractor.sampling_rate / timings["wall"],
+            )
+            writer.add_scalar('TIMING/samples_per_sec', num_examples / timings["wall"], logged_step)
+            writer.add_scalar('TIMING/audio_sec_per_sec',
+                              num_audio_samples / feature_extractor.sampling_rate / timings["wall"],
+                              logged_step)
+            for phase in phases:
+                # mean milliseconds per batch of this process
+                phase_ms = 1000 * timings.get(phase, 0.0) / max(timings["num_batches"], 1)
+                timing_str += "| {}: {:.1f}ms".format(phase, phase_ms)
+                writer.add_scalar('TIMING/' + phase + '_ms', phase_ms, logged_step)
+            progress_bar.write(timing_str)
+
+
+    # generator of the shuffling sampler when the train DataLoader is prepared by accelerate
+    sampler_generator = getattr(train_dataloader, "synchronized_generator", None)
 
     for epoch in range(starting_epoch, args.num_train_epochs):
         if accelerator.is_main_process:
             print(f"\nEpoch {epoch}: ")
         model.train()
-        for step, batch in enumerate(train_dataloader):
+        resume_step = 0
+        if resume_state is not None and epoch == resume_state["epoch"]:
+            resume_step = resume_state["step"]
+            # the data order of an epoch only depends on the RNG states at its start
+            torch.set_rng_state(resume_state["rng_state"])
+            if sampler_generator is not None and resume_state.get("generator_state") is not None:
+                sampler_generator.set_state(resume_state["generator_state"])
+            if accelerator.is_main_process:
+                print(f"Resuming epoch {epoch} at batch {resume_step}")
+        epoch_rng_state = {
+            "rng_state": torch.get_rng_state(),
+            "generator_state": sampler_generator.get_state() if sampler_generator is not None else None,
+        }
+        if args.streaming:
+            train_dataset.set_epoch(epoch, skip_batches=resume_step)
+        elif args.pack_sequences:
+            train_dataset.set_epoch(epoch)
+        if args.pack_sequences and accelerator.is_local_main_process:
+            print("Packed {} windows, {:.1%} filled with audio".format(len(train_dataset), train_dataset.fill_ratio))
+            writer.add_scalar('TRAIN/packing_fill_ratio', train_dataset.fill_ratio, epoch)
+        # skip the batches done before the interruption without loading them
+        epoch_dataloader = train_dataloader
+        if train_batch_sampler is not None:
+            train_batch_sampler.set_epoch(epoch)
+            train_batch_sampler.set_start_batch(resume_step)
+        elif resume_step > 0 and not args.streaming:
+            epoch_dataloader = skip_first_batches(train_dataloader, resume_step)
+        if train_batch_sampler is not None:
+            padding = train_batch_sampler.padding_stats()
+            if accelerator.is_local_main_process:
+                print("Padding ratio: {:.3f} (random batches: {:.3f})".format(
+                    padding["padding_ratio"], padding["padding_ratio_random"]))
+                writer.add_scalar('TRAIN/padding_ratio', padding["padding_ratio"], epoch)
+                writer.add_scalar('TRAIN/mean_batch_size', padding["mean_batch_size"], epoch)
+        # validation and checkpointing are not part of the timed window, nor are the batches counted since the last log
+        step_timer.reset()
+        metrics.discard("throughput")
+        step_timer.waiting()
+        for step, batch in enumerate(epoch_dataloader, start=resume_step):
+            step_timer.batch_ready()
+            batch = send_to_device(batch, accelerator.device)
+            step_timer.mark("h2d")
+            if args.mask_on_device:
+                batch = data_collator.add_masks(batch, generator=mask_generator)
+                step_timer.mark("masks")
+            if step_timer.enabled:
+                # examples and audio samples processed since the last log
+                num_audio_samples = (
+                    batch["attention_mask"].sum()
+                    if "attention_mask" in batch
+                    else torch.full((), batch["input_values"].numel(), device=accelerator.device)
+                )
+                num_examples = torch.full_like(num_audio_samples, batch["input_values"].shape[0])
+                metrics.add("throughput", torch.stack([num_examples, num_audio_samples]))
+            source_ids = batch.pop("source_ids", None)
+            if source_counts is not None:
+                metrics.add("source_counts", torch.bincount(source_ids, minlength=len(source_counts)))
             # compute num of losses
             num_losses = batch["mask_time_indices"].sum()
             sub_attention_mask = batch.pop("sub_attention_mask", None)
@@ -539,12 +1404,15 @@ def main():
             percent_masked = num_losses / sub_attention_mask.sum()
 
             # forward
-            outputs = model(**batch)
+            with torch.autocast(device_type="cpu", dtype=torch.bfloat16, enabled=cpu_autocast):
+                outputs = model(**batch)
+            step_timer.mark("forward")
 
             # divide loss by gradient accumulation steps since gradients
             # are accumulated for multiple backward passes in PyTorch
             loss = outputs.loss / args.gradient_accumulation_steps
             accelerator.backward(loss)
+            step_timer.mark("backward")
 
             # make sure that `num_losses` is summed for distributed training
             # and average gradients over losses of all devices
@@ -554,13 +1422,14 @@ def main():
                 multiply_grads(model.module.parameters(), gradient_multiplier)
             else:
                 multiply_grads(model.parameters(), 1 / num_losses)
+            step_timer.mark("grads")
 
             # update step
             if (step + 1) % args.gradient_accumulation_steps == 0:
 
                 # compute grad norm for monitoring
                 scale = (
-                    accelerator.scaler._scale.item()
+                    accelerator.scaler._scale
                     if hasattr(accelerator, "scaler") and accelerator.scaler is not None
                     else 1
                 )
@@ -568,16 +1437,21 @@ def main():
                     grad_norm = get_grad_norm(model.module.parameters(), scale)
                 else:
                     grad_norm = get_grad_norm(model.parameters(), scale)
+                step_timer.mark("grads")
 
                 # update parameters
                 optimizer.step()
                 optimizer.zero_grad()
+                step_timer.mark("optimizer")
+                if not optimizer_memory_reported:
+                    report_optimizer_memory()
+                    optimizer_memory_reported = True
 
                 if not accelerator.optimizer_step_was_skipped:
                     lr_scheduler.step()
                 elif accelerator.is_local_main_process:
                     progress_bar.write(
-                        f"Gradients have overflown - skipping update step... Updating gradient scale to {scale}..."
+                        f"Gradients have overflown - skipping update step... Updating gradient scale to {float(scale)}..."
                     )
 
                 # update gumbel temperature
@@ -595,44 +1469,52 @@ def main():
 
             # Log all results
             if (step + 1) % (args.gradient_accumulation_steps * args.logging_steps) == 0:
-                loss.detach()
-                outputs.contrastive_loss.detach()
-                outputs.diversity_loss.detach()
                 cosine_sim = torch.cosine_similarity(outputs.projected_states, outputs.projected_quantized_states, dim=-1)
                 cosine_sim = cosine_sim[batch["mask_time_indices"].to(torch.bool)].mean()
 
-                if accelerator.state.num_processes > 1:
-                    loss = accelerator.gather(loss).sum()
-                    outputs.contrastive_loss = accelerator.gather(outputs.contrastive_loss).sum()
-                    outputs.diversity_loss = accelerator.gather(outputs.diversity_loss).sum()
-                    percent_masked = accelerator.gather(percent_masked).sum()
-                    cosine_sim = accelerator.gather(cosine_sim).mean()
-
-                train_logs = {
-                    "step": torch.tensor((step + 1) // args.gradient_accumulation_steps, dtype=torch.int32),
-                    "loss": (loss * args.gradient_accumulation_steps) / num_losses,
-                    "contrast_loss": outputs.contrastive_loss / num_losses,
-                    "div_loss": outputs.diversity_loss / num_losses,
-                    "%_mask_idx": percent_masked / accelerator.num_processes,
-                    "ppl": outputs.codevector_perplexity,
-                    "lr": torch.tensor(lr_scheduler.get_lr()),
-                    "temp": torch.tensor(gumbel_temperature),
-                    "grad_norm": torch.tensor(grad_norm),
-                    "cosine_sim": cosine_sim * 100
-                }
+                # summed across processes in the packed reduction of `flush`
+                metrics.add("loss", loss)
+                metrics.add("contrast_loss", outputs.contrastive_loss)
+                metrics.add("div_loss", outputs.diversity_loss)
+                metrics.add("%_mask_idx", percent_masked)
+                metrics.add("cosine_sim", cosine_sim)
+                # `num_losses` is already summed for distributed training, the gradients are all-reduced
+                metrics.add("num_losses", num_losses, reduce=False)
+                metrics.add("ppl", outputs.codevector_perplexity, reduce=False)
+                metrics.add("grad_norm", grad_norm, reduce=False)
+                metrics.add_host("step", (step + 1) // args.gradient_accumulation_steps)
+                metrics.add_host("lr", lr_scheduler.get_lr()[0])
+                metrics.add_host("temp", gumbel_temperature)
+                if step_timer.enabled:
+                    metrics.add_host("timings", step_timer.summary())
+                metrics.flush(completed_steps)
+
+            for logged_step, values in metrics.completed():
+                write_train_logs(logged_step, values)
+
+            # evaluate on the cached validation batches every `args.validation_steps` steps
+            if (
+                args.validation_steps is not None
+                and (step + 1) % (args.gradient_accumulation_steps * args.validation_steps) == 0
+            ):
+                val_logs = evaluate()
+                model.train()
                 log_str = ""
-                for k, v in train_logs.items():
+                for k, v in val_logs.items():
                     log_str += "| {}: {:.3e}".format(k, v.item())
-
                 if accelerator.is_local_main_process:
                     progress_bar.write(log_str)
-                    for k, v in train_logs.items():
-                        writer.add_scalar('TRAIN' + '/' + k, v, completed_steps)
-
+                    for k, v in val_logs.items():
+                        writer.add_scalar('VALIDATION_STEPS' + '/' + k, v, completed_steps)
 
             # save model every `args.saving_steps` steps
             if (step + 1) % (args.gradient_accumulation_steps * args.saving_steps) == 0:
-                if (args.push_to_hub and epoch < args.num_train_epochs - 1) or args.output_dir is not None:
+                if checkpoint_writer is not None:
+                    if accelerator.is_main_process:
+                        print("****Saving checkpoint*****")
+                    checkpoint_writer.save(model, optimizer, lr_scheduler, feature_extractor, epoch, completed_steps,
+                                           extra={"resume": dict(epoch_rng_state, epoch=epoch, step=step + 1)})
+                elif (args.push_to_hub and epoch < args.num_train_epochs - 1) or args.output_dir is not None:
                     accelerator.wait_for_everyone()
                     unwrapped_model = accelerator.unwrap_model(model)
                     unwrapped_model.save_pretrained(
@@ -643,12 +1525,15 @@ def main():
                         print("****Saving checkpoint*****")
                         state_dict = {
                             "completed_steps": completed_steps,
-                            "epoch": epoch
+                            "epoch": epoch,
+                            "resume": dict(epoch_rng_state, epoch=epoch, step=step + 1)
                         }
                         torch.save(state_dict, os.path.join(args.output_dir, "latest_checkpoint.pt"))
                     accelerator.save_state(args.output_dir)
 
                 if (args.push_to_hub and epoch < args.num_train_epochs - 1) and accelerator.is_main_process:
+                    if checkpoint_writer is not None:
+                        checkpoint_writer.wait()
                     repo.push_to_hub(
                         commit_message=f"Training in progress step {completed_steps}",
                         blocking=False,
@@ -658,33 +1543,13 @@ def main():
             # if completed steps > `args.max_train_steps` stop
             if completed_steps >= args.max_train_steps:
                 break
+            step_timer.waiting()
 
+        for logged_step, values in metrics.completed(block=True):
+            write_train_logs(logged_step, values)
         print("******END OF EPOCH******\n")
         # Validate!
-        model.eval()
-
-        # init logs
-        val_logs = {
-            "val_loss": 0,
-            "val_contrastive_loss": 0,
-            "val_diversity_loss": 0,
-            "val_num_losses": 0,
-        }
-        for step, batch in enumerate(eval_dataloader):
-            with torch.no_grad():
-                batch.pop("sub_attention_mask", None)
-                outputs = model(**batch)
-
-            val_logs["val_loss"] += outputs.loss
-            val_logs["val_contrastive_loss"] += outputs.contrastive_loss
-            val_logs["val_diversity_loss"] += outputs.diversity_loss
-            val_logs["val_num_losses"] += batch["mask_time_indices"].sum()
-
-        # sum over devices in multi-processing
-        if accelerator.num_processes > 1:
-            val_logs = {k: accelerator.gather(v).sum() for k, v in val_logs.items()}
-
-        val_logs = {k: v / val_logs["val_num_losses"] for k, v in val_logs.items()}
+        val_logs = evaluate()
 
         log_str = ""
         for k, v in val_logs.items():
@@ -697,7 +1562,22 @@ def main():
 
 
 
-        if args.output_dir is not None:
+        # a resumed run starts the next epoch from the current RNG states
+        next_epoch_state = {
+            "epoch": epoch + 1,
+            "step": 0,
+            "rng_state": torch.get_rng_state(),
+            "generator_state": sampler_generator.get_state() if sampler_generator is not None else None,
+        }
+        if checkpoint_writer is not None:
+            if accelerator.is_main_process:
+                print("\n****Saving checkpoint*****")
+            checkpoint_writer.save(model, optimizer, lr_scheduler, feature_extractor, epoch, completed_steps,
+                                   extra={"resume": next_epoch_state})
+            if accelerator.is_main_process and args.push_to_hub:
+                checkpoint_writer.wait()
+                repo.push_to_hub(commit_message="End of training", auto_lfs_prune=True)
+        elif args.output_dir is not None:
             accelerator.wait_for_everyone()
             unwrapped_model = accelerator.unwrap_model(model)
             unwrapped_model.save_pretrained(
@@ -708,7 +1588,8 @@ def main():
                 print("\n****Saving checkpoint*****")
                 state_dict = {
                     "completed_steps": completed_steps,
-                    "epoch": epoch
+                    "epoch": epoch,
+                    "resume": next_epoch_state
                 }
                 torch.save(state_dict, os.path.join(args.output_dir, "latest_checkpoint.pt"))
 
@@ -717,5 +1598,9 @@ def main():
                 if args.push_to_hub:
                     repo.push_to_hub(commit_message="End of training", auto_lfs_prune=True)
 
+    # the last checkpoint has to be on disk before the process exits
+    if checkpoint_writer is not None:
+        checkpoint_writer.wait()
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,220 @@
+"""Batch samplers for wav2vec2 pretraining.
+
+The samplers shard batches across processes themselves (like `DistributedSampler`), so a DataLoader using them must
+not be passed through `accelerator.prepare`. Batches are built from the same seeded permutation on every process;
+consecutive groups of `num_replicas` batches hold examples of similar length and are handed out one per rank, so no
+rank waits on a much longer batch at the gradient all-reduce.
+"""
+
+import numpy as np
+
+from torch.utils.data import Sampler
+from typing import Dict, Iterator, List
+
+
+def padding_stats(batches: List[np.ndarray], lengths: np.ndarray) -> Dict[str, float]:
+    """Fraction of the padded input that is padding, when every batch is padded to its longest example."""
+    real = sum(lengths[batch].sum() for batch in batches)
+    padded = sum(lengths[batch].max() * len(batch) for batch in batches)
+    return {
+        "padding_ratio": 1 - real / padded if padded > 0 else 0.0,
+        "num_batches": len(batches),
+        "mean_batch_size": float(np.mean([len(batch) for batch in batches])) if batches else 0.0,
+    }
+
+
+def source_probabilities(weights, temperature: float = 1.0) -> np.ndarray:
+    """Sampling probability of every source, proportional to `weights ** (1 / temperature)`."""
+    probabilities = np.asarray(weights, dtype=np.float64) ** (1 / temperature)
+    return probabilities / probabilities.sum()
+
+
+class DistributedBatchSampler(Sampler):
+    """
+    Base class for the length-aware batch samplers.
+    Args:
+        lengths: Length (e.g. duration in seconds) of every example of the dataset
+        num_replicas: Number of processes taking part in training
+        rank: Rank of the current process
+        seed: Seed shared by all processes, combined with the epoch set by `set_epoch`
+    """
+
+    def __init__(self, lengths, num_replicas: int = 1, rank: int = 0, seed: int = 0):
+        self.lengths = np.asarray(lengths, dtype=np.float64)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+        self._cache = None
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def set_start_batch(self, start_batch: int) -> None:
+        """Start the next iteration at batch `start_batch` of this rank's epoch, e.g. to resume training."""
+        self.start_batch = start_batch
+
+    def global_batches(self, rng: np.random.Generator) -> List[np.ndarray]:
+        raise NotImplementedError
+
+    def _all_batches(self) -> List[np.ndarray]:
+        # Batches of all ranks for the current epoch, ordered so that batch i goes to rank i % num_replicas
+        if self._cache is not None and self._cache[0] == self.epoch:
+            return self._cache[1]
+        rng = np.random.default_rng([self.seed, self.epoch])
+        batches = self.global_batches(rng)
+        groups = [batches[i : i + self.num_replicas] for i in range(0, len(batches), self.num_replicas)]
+        batches = [batch for group_id in rng.permutation(len(groups)) for batch in groups[group_id]]
+        # Repeat batches from the start, cyclically if there are fewer batches than ranks, so every rank gets the same
+        # number of batches
+        num_missing = -len(batches) % self.num_replicas
+        if batches and num_missing > 0:
+            batches = batches + [batches[i % len(batches)] for i in range(num_missing)]
+        self._cache = (self.epoch, batches)
+        return batches
+
+    def padding_stats(self) -> Dict[str, float]:
+        """Padding statistics of the current epoch, next to those of randomly composed batches of the same sizes."""
+        batches = self._all_batches()
+        stats = padding_stats(batches, self.lengths)
+        if not batches:
+            return stats
+        rng = np.random.default_rng([self.seed, self.epoch])
+        split_points = np.cumsum([len(batch) for batch in batches])[:-1]
+        shuffled = np.concatenate(batches)[rng.permutation(sum(len(batch) for batch in batches))]
+        stats["padding_ratio_random"] = padding_stats(np.split(shuffled, split_points), self.lengths)["padding_ratio"]
+        return stats
+
+    def __iter__(self) -> Iterator[List[int]]:
+        start_batch, self.start_batch = self.start_batch, 0
+        for batch in self._all_batches()[self.rank :: self.num_replicas][start_batch:]:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        return len(self._all_batches()) // self.num_replicas
+
+
+class BucketBatchSampler(DistributedBatchSampler):
+    """
+    Groups examples of similar length into fixed-size batches to reduce padding.
+    Every epoch the dataset is shuffled and cut into buckets of `batch_size * bucket_size` examples, which are
+    sorted by length and split into batches. The leftovers of all buckets are sorted and batched together, so only
+    the very last batch of an epoch can be smaller than `batch_size`.
+    """
+
+    def __init__(self, lengths, batch_size: int, bucket_size: int = 100, drop_last: bool = False,
+                 num_replicas: int = 1, rank: int = 0, seed: int = 0):
+        super().__init__(lengths, num_replicas=num_replicas, rank=rank, seed=seed)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+
+    def _split(self, indices: np.ndarray):
+        indices = indices[np.argsort(-self.lengths[indices], kind="stable")]
+        num_full = len(indices) // self.batch_size * self.batch_size
+        batches = [indices[i : i + self.batch_size] for i in range(0, num_full, self.batch_size)]
+        return batches, indices[num_full:]
+
+    def global_batches(self, rng: np.random.Generator) -> List[np.ndarray]:
+        permutation = rng.permutation(len(self.lengths))
+        bucket = self.batch_size * self.bucket_size
+        batches, leftovers = [], []
+        for start in range(0, len(permutation), bucket):
+            bucket_batches, leftover = self._split(permutation[start : start + bucket])
+            batches += bucket_batches
+            leftovers.append(leftover)
+        if not leftovers:
+            # empty dataset, e.g. every example filtered out
+            return []
+        leftover_batches, last = self._split(np.concatenate(leftovers))
+        batches += leftover_batches
+        if len(last) > 0 and not self.drop_last:
+            batches.append(last)
+        return batches
+
+
+class DurationBudgetBatchSampler(DistributedBatchSampler):
+    """
+    Builds variable-size batches that are filled up to a duration budget instead of a fixed number of examples.
+    Args:
+        max_batch_duration: Budget per batch, in the unit of `lengths`
+        budget: "padded" bounds the padded batch (longest example times number of examples), "audio" bounds the
+                summed length of the examples
+        bucket_size: Approximate number of batches whose examples are sorted by length together
+    """
+
+    def __init__(self, lengths, max_batch_duration: float, budget: str = "padded", bucket_size: int = 100,
+                 num_replicas: int = 1, rank: int = 0, seed: int = 0):
+        super().__init__(lengths, num_replicas=num_replicas, rank=rank, seed=seed)
+        if budget not in ("padded", "audio"):
+            raise ValueError(f"Unknown budget {budget}, expected 'padded' or 'audio'")
+        self.max_batch_duration = max_batch_duration
+        self.budget = budget
+        examples_per_batch = max(1, int(max_batch_duration / max(self.lengths.mean(), 1e-6))) if len(lengths) else 1
+        self.bucket_examples = examples_per_batch * bucket_size
+
+    def _split(self, indices: np.ndarray) -> List[np.ndarray]:
+        indices = indices[np.argsort(-self.lengths[indices], kind="stable")]
+        batches, start, longest, total = [], 0, 0.0, 0.0
+        for i, length in enumerate(self.lengths[indices]):
+            count = i - start + 1
+            longest, total = max(longest, length), total + length
+            cost = longest * count if self.budget == "padded" else total
+            if count > 1 and cost > self.max_batch_duration:
+                batches.append(indices[start:i])
+                start, longest, total = i, length, length
+        if start < len(indices):
+            batches.append(indices[start:])
+        return batches
+
+    def global_batches(self, rng: np.random.Generator) -> List[np.ndarray]:
+        permutation = rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(permutation), self.bucket_examples):
+            batches += self._split(permutation[start : start + self.bucket_examples])
+        return batches
+
+
+class WeightedSourceBatchSampler(DistributedBatchSampler):
+    """
+    Interleaves several sources (e.g. corpora) with per-source sampling probabilities instead of concatenating them.
+    Every epoch `epoch_size` examples are drawn: the source of each example is sampled from the mixture, and the
+    example itself is taken from a random permutation of that source, which is only created once the source is drawn
+    and restarted when exhausted, so small sources are repeated and large ones subsampled.
+    Args:
+        source_ids: Source of every example of the dataset
+        num_sources: Number of sources, defaults to the largest source id plus one
+        batch_size: Number of examples per batch
+        weights: Sampling weight of every source, defaults to the source sizes
+        temperature: Probabilities are proportional to `weights ** (1 / temperature)`; 1 keeps the weights, larger
+                     values move towards uniform sampling of the sources
+        epoch_size: Number of examples per epoch, defaults to the size of the dataset
+    """
+
+    def __init__(self, source_ids, batch_size: int, num_sources: int = None, weights=None, temperature: float = 1.0,
+                 epoch_size: int = None, drop_last: bool = False, num_replicas: int = 1, rank: int = 0, seed: int = 0):
+        source_ids = np.asarray(source_ids, dtype=np.int64)
+        super().__init__(np.ones(len(source_ids)), num_replicas=num_replicas, rank=rank, seed=seed)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.epoch_size = len(source_ids) if epoch_size is None else epoch_size
+        num_sources = source_ids.max() + 1 if num_sources is None else num_sources
+        self.source_indices = [np.flatnonzero(source_ids == s) for s in range(num_sources)]
+        sizes = np.array([len(indices) for indices in self.source_indices], dtype=np.float64)
+        weights = sizes if weights is None else np.asarray(weights, dtype=np.float64)
+        if len(weights) != len(sizes):
+            raise ValueError(f"Got {len(weights)} source weights for {len(sizes)} sources")
+        self.probabilities = source_probabilities(np.where(sizes > 0, weights, 0), temperature)
+
+    def global_batches(self, rng: np.random.Generator) -> List[np.ndarray]:
+        sources = rng.choice(len(self.probabilities), size=self.epoch_size, p=self.probabilities)
+        indices = np.empty(self.epoch_size, dtype=np.int64)
+        for source in np.unique(sources):
+            positions = np.flatnonzero(sources == source)
+            candidates = self.source_indices[source]
+            num_permutations = -(-len(positions) // len(candidates))
+            drawn = np.concatenate([rng.permutation(candidates) for _ in range(num_permutations)])
+            indices[positions] = drawn[: len(positions)]
+        num_batches = len(indices) // self.batch_size if self.drop_last else -(-len(indices) // self.batch_size)
+        return [indices[i * self.batch_size : (i + 1) * self.batch_size] for i in range(num_batches)]
@@ -0,0 +1,148 @@
+"""Pre-decoded audio shard store for wav2vec2 pretraining.
+
+`pack_manifests` decodes every audio file referenced by the CSV manifests once and appends it as raw int16 PCM to a
+small number of large shard files, together with an `index.csv` holding the shard, offset and length of every clip.
+`ShardStore` then serves waveforms as zero-copy `np.memmap` slices from those shards, so the DataLoader workers no
+longer open and decode one small file per example.
+
+Usage:
+    python shard_store.py --manifests train.csv val.csv --separator , --output_dir /data/shards --num_workers 16
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import soundfile as sf
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from tqdm import tqdm
+
+INDEX_NAME = "index.csv"
+SHARD_NAME = "shard_{:05d}.bin"
+SHARD_DTYPE = np.int16
+
+
+def _decode(path: str) -> Tuple[np.ndarray, int]:
+    wav, sr = sf.read(path, dtype="int16")
+    if wav.ndim > 1:
+        # Changes stereo to mono, same as the (commented) conversion in CustomDataset
+        wav = wav.mean(axis=1).astype(SHARD_DTYPE)
+    return wav, sr
+
+
+def bounded_map(executor, fn, items, window: int):
+    """Like `executor.map`, in order, but with at most `window` items in flight, so decoded audio the consumer has not
+    written yet does not pile up in memory."""
+    futures = deque()
+    for item in items:
+        futures.append(executor.submit(fn, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def pack_manifests(manifests: List[str], output_dir: str, sep: str = ",", audio_column_name: str = "path",
+                   sr: int = 16000, shard_size_mb: int = 1024, num_workers: int = 1) -> pd.DataFrame:
+    """
+    Decode every audio file referenced by `manifests` and pack them into int16 shards in `output_dir`.
+    Args:
+        manifests: CSV manifests with an `audio_column_name` column
+        output_dir: Directory receiving the shards and the index
+        sr: Expected sampling rate, files with another rate are rejected
+        shard_size_mb: A new shard is started once the current one exceeds this size
+        num_workers: Number of processes decoding audio in parallel
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = pd.concat(
+        [pd.read_csv(manifest, sep=sep, engine="python")[audio_column_name] for manifest in manifests],
+        ignore_index=True
+    ).drop_duplicates().tolist()
+
+    shard_bytes = shard_size_mb * 1024 * 1024
+    index: Dict[str, list] = {"path": [], "shard": [], "offset": [], "num_frames": []}
+    shard_id, offset = 0, 0
+    shard_file = open(os.path.join(output_dir, SHARD_NAME.format(shard_id)), "wb")
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        decoded = bounded_map(executor, _decode, paths, window=4 * num_workers)
+        for path, (wav, file_sr) in tqdm(zip(paths, decoded), total=len(paths)):
+            if file_sr != sr:
+                raise ValueError(f"{path} has a sampling rate of {file_sr}, expected {sr}")
+            if offset > 0 and (offset + len(wav)) * SHARD_DTYPE().itemsize > shard_bytes:
+                shard_file.close()
+                shard_id, offset = shard_id + 1, 0
+                shard_file = open(os.path.join(output_dir, SHARD_NAME.format(shard_id)), "wb")
+            shard_file.write(np.ascontiguousarray(wav, dtype=SHARD_DTYPE).tobytes())
+            index["path"].append(path)
+            index["shard"].append(shard_id)
+            index["offset"].append(offset)
+            index["num_frames"].append(len(wav))
+            offset += len(wav)
+    shard_file.close()
+
+    # Write the index last, and atomically, so a crashed pack never leaves a usable but incomplete store behind
+    index = pd.DataFrame(index)
+    index["sr"] = sr
+    tmp_path = os.path.join(output_dir, INDEX_NAME + ".tmp")
+    index.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, os.path.join(output_dir, INDEX_NAME))
+    print(f"Packed {len(index)} files into {shard_id + 1} shards in {output_dir}")
+    return index
+
+
+class ShardStore:
+    def __init__(self, shard_dir: str):
+        self.shard_dir = shard_dir
+        index = pd.read_csv(os.path.join(shard_dir, INDEX_NAME), usecols=["shard", "offset", "num_frames", "sr"])
+        self.shard = index["shard"].to_numpy(np.int32)
+        self.offset = index["offset"].to_numpy(np.int64)
+        self.num_frames = index["num_frames"].to_numpy(np.int64)
+        self.sr = int(index["sr"].iloc[0]) if len(index) else None
+        # Memmaps are opened lazily, so every DataLoader worker maps the shards itself after the fork
+        self._shards: Dict[int, np.memmap] = {}
+
+    def __len__(self) -> int:
+        return len(self.num_frames)
+
+    def lookup(self, paths) -> np.ndarray:
+        """Map audio paths to entry ids of the store (-1 for paths that were not packed)."""
+        index_paths = pd.read_csv(os.path.join(self.shard_dir, INDEX_NAME), usecols=["path"])["path"]
+        return pd.Index(index_paths).get_indexer(pd.Index(paths)).astype(np.int64)
+
+    def _get_shard(self, shard_id: int) -> np.memmap:
+        if shard_id not in self._shards:
+            path = os.path.join(self.shard_dir, SHARD_NAME.format(shard_id))
+            self._shards[shard_id] = np.memmap(path, dtype=SHARD_DTYPE, mode="r")
+        return self._shards[shard_id]
+
+    def read(self, entry: int, start: int = 0, frames: Optional[int] = None) -> np.memmap:
+        """Zero-copy int16 view of (a window of) the waveform stored under `entry`."""
+        length = self.num_frames[entry]
+        end = length if frames is None else min(start + frames, length)
+        begin = self.offset[entry]
+        return self._get_shard(self.shard[entry])[begin + start : begin + end]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pack CSV manifests into memory-mapped int16 audio shards")
+    parser.add_argument("--manifests", nargs="+", type=str, required=True, help="CSV manifests to pack.")
+    parser.add_argument("--output_dir", type=str, required=True, help="Where to write the shards and the index.")
+    parser.add_argument("--separator", type=str, default=",", help="Separator of the CSV manifests.")
+    parser.add_argument("--audio_column_name", type=str, default="path", help="Column with the audio file path.")
+    parser.add_argument("--sampling_rate", type=int, default=16000, help="Expected sampling rate of the audio.")
+    parser.add_argument("--shard_size_mb", type=int, default=1024, help="Maximum size of a single shard in MB.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(), help="Number of decoding processes.")
+    args = parser.parse_args()
+
+    pack_manifests(
+        args.manifests,
+        args.output_dir,
+        sep=args.separator,
+        audio_column_name=args.audio_column_name,
+        sr=args.sampling_rate,
+        shard_size_mb=args.shard_size_mb,
+        num_workers=args.num_workers)
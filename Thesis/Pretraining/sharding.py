@@ -0,0 +1,52 @@
+"""Optimizer state sharding (ZeRO stage 1) for multi-process pretraining.
+
+`ShardedOptimizer` partitions the parameters across processes, so every process only keeps the AdamW moments of its
+own partition and broadcasts the updated parameters after the step. Its state dict is the full, unpartitioned state
+dict of the wrapped optimizer class, consolidated on rank 0, so checkpoints written with `accelerator.save_state` load
+with any number of processes (and without sharding).
+"""
+
+import torch
+import torch.distributed as dist
+
+from torch.distributed.optim import ZeroRedundancyOptimizer
+from typing import Any, Dict
+
+
+class ShardedOptimizer(ZeroRedundancyOptimizer):
+    def state_dict(self) -> Dict[str, Any]:
+        """Collective call: the full state dict on rank 0, the parameter groups without state on the other ranks."""
+        self.consolidate_state_dict(to=0)
+        if self.rank == 0:
+            return super().state_dict()
+        # the other ranks only need a loadable state dict, e.g. for the device placement of accelerate
+        return torch.optim.Optimizer.state_dict(self)
+
+
+def create_optimizer(params, shard_state: bool = False, **kwargs) -> torch.optim.Optimizer:
+    """AdamW, with its state sharded across processes if `shard_state` and training is distributed."""
+    if shard_state and dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+        return ShardedOptimizer(params, optimizer_class=torch.optim.AdamW, **kwargs)
+    return torch.optim.AdamW(params, **kwargs)
+
+
+def optimizer_state_mb(optimizer: torch.optim.Optimizer) -> float:
+    """Memory of the optimizer state held by this process."""
+    optimizer = getattr(optimizer, "optimizer", optimizer)
+    local = optimizer.optim if isinstance(optimizer, ZeroRedundancyOptimizer) else optimizer
+    return sum(
+        value.numel() * value.element_size()
+        for state in local.state.values()
+        for value in state.values()
+        if torch.is_tensor(value)
+    ) / 2**20
+
+
+def expected_state_mb(optimizer: torch.optim.Optimizer, replicated: bool = False) -> float:
+    """Memory of the two AdamW moments of the parameters this process owns, or of all parameters if `replicated`."""
+    optimizer = getattr(optimizer, "optimizer", optimizer)
+    if isinstance(optimizer, ZeroRedundancyOptimizer) and not replicated:
+        groups = optimizer.optim.param_groups
+    else:
+        groups = optimizer.param_groups
+    return sum(2 * p.numel() * p.element_size() for group in groups for p in group["params"]) / 2**20
@@ -0,0 +1,74 @@
+"""Per-phase timing of the training steps of the pretraining script.
+
+The time spent waiting for the DataLoader is measured with the host clock. The phases running on the device (host to
+device copy, masking, forward, backward, gradient scaling and norm, optimizer step) are measured with CUDA events on
+GPUs, so timing does not add synchronizations to the training loop; the events are only resolved when `summary` is
+called at logging time. On other devices all phases use the host clock. A disabled timer returns immediately from every call.
+"""
+
+import time
+import torch
+
+from collections import defaultdict
+from typing import Dict
+
+
+class StepTimer:
+    def __init__(self, device: torch.device, enabled: bool = True):
+        self.enabled = enabled
+        self.use_events = enabled and device.type == "cuda"
+        self.totals: Dict[str, float] = defaultdict(float)
+        self.pending = []
+        self.num_batches = 0
+        self.wait_start = None
+        self.last = None
+        self.window_start = time.perf_counter()
+
+    def _now(self):
+        if self.use_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def waiting(self) -> None:
+        """Called when the loop starts waiting for the next batch."""
+        if self.enabled:
+            self.wait_start = time.perf_counter()
+
+    def batch_ready(self) -> None:
+        """Called when a batch arrived, starts the chain of device phases."""
+        if not self.enabled:
+            return
+        if self.wait_start is not None:
+            self.totals["data_wait"] += time.perf_counter() - self.wait_start
+        self.num_batches += 1
+        self.last = self._now()
+
+    def mark(self, phase: str) -> None:
+        """Ends `phase`, which started at the previous mark (or when the batch arrived)."""
+        if not self.enabled:
+            return
+        now = self._now()
+        if self.use_events:
+            self.pending.append((phase, self.last, now))
+        else:
+            self.totals[phase] += now - self.last
+        self.last = now
+
+    def reset(self) -> None:
+        """Starts a new window, discarding the measurements since the last summary."""
+        self.totals.clear()
+        self.pending.clear()
+        self.num_batches = 0
+        self.window_start = time.perf_counter()
+
+    def summary(self) -> Dict[str, float]:
+        """Seconds spent in every phase since the last summary, and the wall time of the window, then resets."""
+        if self.pending:
+            self.pending[-1][2].synchronize()
+            for phase, start, end in self.pending:
+                self.totals[phase] += start.elapsed_time(end) / 1000
+        summary = dict(self.totals, wall=time.perf_counter() - self.window_start, num_batches=self.num_batches)
+        self.reset()
+        return summary